@@ -5,6 +5,7 @@ import numpy as np
 import tensorflow as tf
 from bert4keras.backend import keras, K
 from bert4keras.backend import sequence_masking
+from bert4keras.backend import batch_gather
 from bert4keras.backend import recompute_grad
 from keras import initializers, activations
 from keras.layers import *
@@ -614,10 +615,15 @@ class FeedForward(Layer):
 class ConditionalRandomField(Layer):
     """纯Keras实现CRF层
     CRF层本质上是一个带训练参数的loss计算层。
+    log_norm_mode为'rnn'时用K.rnn逐步递归计算log Z；为'scan'时用矩阵
+    两两相乘的并行算法，串行深度从seq_len降到log(seq_len)，结果相同。
     """
-    def __init__(self, lr_multiplier=1, **kwargs):
+    def __init__(self, lr_multiplier=1, log_norm_mode='rnn', **kwargs):
         super(ConditionalRandomField, self).__init__(**kwargs)
         self.lr_multiplier = lr_multiplier  # 当前层学习率的放大倍数
+        if log_norm_mode not in ['rnn', 'scan']:
+            raise ValueError('log_norm_mode must be "rnn" or "scan"')
+        self.log_norm_mode = log_norm_mode  # log Z的计算方式
 
     @integerize_shape
     def build(self, input_shape):
@@ -672,6 +678,51 @@ class ConditionalRandomField(Layer):
         outputs = mask * outputs + (1 - mask) * states[:, :, 0]
         return outputs, [outputs]
 
+    def log_norm_scan(self, inputs, mask):
+        """并行计算log Z（返回最后一步的log Z向量）
+        要点：1、log_norm_step的每一步等价于乘以log空间的矩阵
+        trans + inputs[t]（padding部分为单位阵）；2、矩阵乘法满足结合律，
+        所以每轮两两相乘，log(seq_len)轮即可得到所有矩阵的乘积。
+        """
+        output_dim = K.int_shape(inputs)[-1]
+        identity = (1 - tf.eye(output_dim)) * -1e12  # log空间的单位阵
+        matrices = K.expand_dims(self.trans, 0) + K.expand_dims(inputs[:, 1:], 2)
+        mask = K.expand_dims(mask[:, 1:], 3)
+        matrices = mask * matrices + (1 - mask) * identity
+        # 用单位阵补齐到2的整数次幂个矩阵
+        batch_size, length = K.shape(matrices)[0], K.shape(matrices)[1]
+        levels = tf.math.ceil(
+            tf.math.log(K.cast(K.maximum(length, 1), 'float64')) / np.log(2)
+        )
+        levels = K.cast(levels, 'int32')
+        padding = tf.tile(
+            identity[None, None], [batch_size, 2**levels - length, 1, 1]
+        )
+        matrices = K.concatenate([matrices, padding], 1)
+
+        def multiply(i, matrices):
+            # 相邻两个矩阵在log空间相乘
+            shape = K.shape(matrices)
+            matrices = K.reshape(
+                matrices, (shape[0], shape[1] // 2, 2, output_dim, output_dim)
+            )
+            matrices = tf.reduce_logsumexp(
+                K.expand_dims(matrices[:, :, 0], 4) +
+                K.expand_dims(matrices[:, :, 1], 2), 3
+            )
+            return i + 1, matrices
+
+        _, matrices = tf.while_loop(
+            lambda i, matrices: i < levels,
+            multiply, [K.constant(0, dtype='int32'), matrices],
+            shape_invariants=[
+                tf.TensorShape([]),
+                tf.TensorShape([None, None, output_dim, output_dim])
+            ]
+        )
+        states = K.expand_dims(inputs[:, 0], 2)  # (batch_size, output_dim, 1)
+        return tf.reduce_logsumexp(states + matrices[:, 0], 1)
+
     def dense_loss(self, y_true, y_pred):
         """y_true需要是one hot形式
         """
@@ -682,15 +733,18 @@ class ConditionalRandomField(Layer):
         y_true, y_pred = y_true * mask, y_pred * mask
         target_score = self.target_score(y_true, y_pred)
         # 递归计算log Z
-        init_states = [y_pred[:, 0]]
-        y_pred = K.concatenate([y_pred, mask], axis=2)
-        input_length = K.int_shape(y_pred[:, 1:])[1]
-        log_norm, _, _ = K.rnn(
-            self.log_norm_step,
-            y_pred[:, 1:],
-            init_states,
-            input_length=input_length
-        )  # 最后一步的log Z向量
+        if self.log_norm_mode == 'scan':
+            log_norm = self.log_norm_scan(y_pred, mask)  # 最后一步的log Z向量
+        else:
+            init_states = [y_pred[:, 0]]
+            y_pred = K.concatenate([y_pred, mask], axis=2)
+            input_length = K.int_shape(y_pred[:, 1:])[1]
+            log_norm, _, _ = K.rnn(
+                self.log_norm_step,
+                y_pred[:, 1:],
+                init_states,
+                input_length=input_length
+            )  # 最后一步的log Z向量
         log_norm = tf.reduce_logsumexp(log_norm, 1)  # logsumexp得标量
         # 计算损失 -log p
         return log_norm - target_score
@@ -727,9 +781,62 @@ class ConditionalRandomField(Layer):
         isequal = K.cast(K.equal(y_true, y_pred), K.floatx())
         return K.sum(isequal * mask) / K.sum(mask)
 
+    def viterbi_step(self, inputs, states):
+        """递归计算每一步的最优路径得分，并输出回溯指针
+        要点：把log_norm_step中的logsumexp换成max；padding部分得分
+        保持不变，回溯指针指向标签自身。
+        """
+        inputs, mask = inputs[:, :-1], inputs[:, -1:]
+        states = K.expand_dims(states[0], 2)  # (batch_size, output_dim, 1)
+        trans = K.expand_dims(self.trans, 0)  # (1, output_dim, output_dim)
+        scores = states + trans  # (batch_size, output_dim, output_dim)
+        outputs = K.max(scores, 1) + inputs
+        outputs = mask * outputs + (1 - mask) * states[:, :, 0]
+        pointers = K.cast(K.argmax(scores, 1), K.floatx())
+        identity = K.cast(K.arange(0, K.shape(inputs)[1]), K.floatx())
+        pointers = mask * pointers + (1 - mask) * K.expand_dims(identity, 0)
+        return pointers, [outputs]
+
+    def backtrace_step(self, inputs, states):
+        """沿回溯指针由当前标签得到前一步的标签
+        """
+        outputs = batch_gather(inputs, states[0])  # (batch_size, 1)
+        return outputs, [outputs]
+
+    def viterbi_decode(self, inputs, mask=None):
+        """在计算图内做Viterbi解码，返回int32的标签序列，padding部分为0
+        inputs是本层的输出；mask为None时从inputs中导出（同sparse_accuracy）。
+        """
+        if mask is None:
+            mask = K.all(K.greater(inputs, -1e6), axis=2)
+        mask = K.cast(mask, K.floatx())
+        # 前向递归，记录每一步的回溯指针
+        init_states = [inputs[:, 0]]
+        inputs = K.concatenate([inputs, K.expand_dims(mask, 2)], axis=2)
+        input_length = K.int_shape(inputs[:, 1:])[1]
+        _, pointers, states = K.rnn(
+            self.viterbi_step,
+            inputs[:, 1:],
+            init_states,
+            input_length=input_length
+        )  # pointers.shape=(batch_size, seq_len - 1, output_dim)
+        # 从最后一步的最优标签开始反向回溯
+        last_tags = K.cast(K.argmax(states[0], 1), K.floatx())
+        last_tags = K.expand_dims(last_tags, 1)  # (batch_size, 1)
+        _, tags, _ = K.rnn(
+            self.backtrace_step,
+            pointers,
+            [last_tags],
+            go_backwards=True,
+            input_length=input_length
+        )  # 反向递归的输出是倒序的
+        tags = K.concatenate([K.reverse(tags[:, :, 0], 1), last_tags], 1)
+        return K.cast(tags * mask, 'int32')
+
     def get_config(self):
         config = {
             'lr_multiplier': self.lr_multiplier,
+            'log_norm_mode': self.log_norm_mode,
         }
         base_config = super(ConditionalRandomField, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
@@ -2,6 +2,8 @@
 # 代码合集
 
 import six
+import copy
+import itertools
 import logging
 import numpy as np
 import re
@@ -187,21 +189,32 @@ def parallel_apply(
         return [r[1] for r in results]
 
 
-def sequence_padding(inputs, length=None, padding=0):
+def sequence_padding(inputs, length=None, padding=0, dtype=None, mode='post'):
     """Numpy函数，将序列padding到同一长度
+    一次性分配好(batch_size, length, ...)的输出，再逐条拷贝进去。
+    参数：
+        dtype: 输出类型，None时与np.array对输入的推断一致；
+        mode: 'post'在序列右侧padding，'pre'在左侧padding。
     """
+    inputs = [np.asarray(x) for x in inputs]
     if length is None:
         length = max([len(x) for x in inputs])
+    if dtype is None:
+        dtype = np.result_type(*set(x.dtype for x in inputs))
 
-    pad_width = [(0, 0) for _ in np.shape(inputs[0])]
-    outputs = []
-    for x in inputs:
+    outputs = np.full(
+        (len(inputs), length) + inputs[0].shape[1:], padding, dtype=dtype
+    )
+    for i, x in enumerate(inputs):
         x = x[:length]
-        pad_width[0] = (0, length - len(x))
-        x = np.pad(x, pad_width, 'constant', constant_values=padding)
-        outputs.append(x)
+        if mode == 'post':
+            outputs[i, :len(x)] = x
+        elif mode == 'pre':
+            outputs[i, length - len(x):] = x
+        else:
+            raise ValueError('"mode" argument must be "post" or "pre".')
 
-    return np.array(outputs)
+    return outputs
 
 
 def text_segmentate(text, maxlen, seps='\n', strips=None):
@@ -236,19 +249,144 @@ def is_one_of(x, ys):
     return False
 
 
+class RaggedArray(object):
+    """变长序列（ragged）数组的只读mmap视图
+    磁盘格式：path + '.bin'为所有序列首尾拼接的扁平数组，path + '.idx.npy'
+    为int64的起始偏移（长度为序列数+1）。可由tokenizers.tokenize_corpus
+    生成，支持len和下标访问，可以直接作为DataGenerator的data。
+    """
+    def __init__(self, path, dtype='int32'):
+        self.dtype = dtype
+        self.offsets = np.load(path + '.idx.npy', mmap_mode='r')
+        if self.offsets[-1] > 0:
+            self.values = np.memmap(path + '.bin', dtype=dtype, mode='r')
+        else:  # 空文件无法mmap
+            self.values = np.zeros(0, dtype=dtype)
+
+    @staticmethod
+    def save(path, sequences, dtype='int32'):
+        """将若干序列逐条写入为ragged格式，返回序列数
+        """
+        offsets = [0]
+        with _open_(path + '.bin', 'wb') as writer:
+            for sequence in sequences:
+                sequence = np.asarray(sequence, dtype=dtype)
+                writer.write(sequence.tobytes())
+                offsets.append(offsets[-1] + len(sequence))
+        np.save(path + '.idx.npy', np.array(offsets, dtype='int64'))
+        return len(offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('RaggedArray index out of range')
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class IndexedDataset(object):
+    """按下标数组取子集的只读视图（如K折交叉验证的各折）
+    只保存原数据的引用和一个int数组，不复制样本，第i条为data[indices[i]]。
+    支持len和下标访问，可以直接作为DataGenerator的data。
+    """
+    def __init__(self, data, indices):
+        indices = np.asarray(indices, dtype='int64')
+        if isinstance(data, IndexedDataset):  # 视图的视图直接合并下标
+            data, indices = data.data, data.indices[indices]
+        self.data = data
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return IndexedDataset(self.data, self.indices[i])
+        return self.data[int(self.indices[i])]
+
+    def __iter__(self):
+        for i in self.indices:
+            yield self.data[int(i)]
+
+
 class DataGenerator(object):
     """数据生成器模版
+    参数：
+        bucket_by: 样本长度函数，非None时随机采样按长度分桶，减少padding；
+        bucket_chunk: 分桶时每次排序的batch数；
+        max_tokens: 非None时按token预算动态组batch（需要bucket_by），
+                    batch_size为每个batch样本数的上限；
+        batch_size_multiple: 动态batch的样本数尽量取它的整数倍；
+        seed: 随机数种子，分片时各worker必须相同；
+        num_shards, shard_index: 数据分片，只遍历第shard_index片；
+        even_shards: 可索引的data在各分片间循环补齐，使各分片步数相同。
     """
-    def __init__(self, data, batch_size=32, buffer_size=None):
+    def __init__(
+        self,
+        data,
+        batch_size=32,
+        buffer_size=None,
+        bucket_by=None,
+        bucket_chunk=100,
+        max_tokens=None,
+        batch_size_multiple=1,
+        seed=None,
+        num_shards=1,
+        shard_index=0,
+        even_shards=True
+    ):
         self.data = data   #数据和batch大小
         self.batch_size = batch_size
+        self.bucket_by = bucket_by
+        self.bucket_chunk = bucket_chunk
+        self.max_tokens = max_tokens
+        self.batch_size_multiple = batch_size_multiple
+        self.padding_stats = {'tokens': 0, 'padded': 0, 'unbucketed': 0}
+        if seed is None:
+            self.rng = np.random  # 采样所用的随机数生成器
+        else:
+            self.rng = np.random.RandomState(seed)
+        self.seed = seed
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.even_shards = even_shards
+        self.epoch = 0  # 已开始的随机epoch数，用于分片的逐epoch重排
+        if not 0 <= shard_index < num_shards:
+            raise ValueError('shard_index must be in [0, num_shards)')
         if hasattr(self.data, '__len__'): #定义了__len__方法后
-            self.steps = len(self.data) // self.batch_size #计算总共需要训练的步数。
-            if len(self.data) % self.batch_size != 0:  #最后一部分不满一个batch，也算一个batch。
+            if num_shards > 1 and seed is None:
+                raise ValueError('sharding indexable data requires seed')
+            num_samples = len(self.shard_indices(len(self.data)))  #本分片的样本数
+            self.steps = num_samples // self.batch_size #计算总共需要训练的步数。
+            if num_samples % self.batch_size != 0:  #最后一部分不满一个batch，也算一个batch。
                 self.steps += 1
         else:
             self.steps = None #如果没有定义len方法，就令总步数为None
         self.buffer_size = buffer_size or batch_size * 1000  #buffer_size没有定义就等于batch_size的1000倍。
+        self.token_batches = None
+        if self.max_tokens is not None:
+            if self.bucket_by is None:
+                raise ValueError('max_tokens requires bucket_by')
+            if self.steps is not None:  # 固定的动态batch划分，决定了总步数
+                lengths = np.array([self.bucket_by(d) for d in self.data])
+                self.token_lengths = lengths
+                self.token_batches = self.token_budget_batches(lengths)
+                self.steps = len(self.shard_indices(
+                    len(self.token_batches)
+                ))  # 分片时以batch为单位切分
 
     def __len__(self):
         return self.steps #获取总训练步数。
@@ -257,48 +395,298 @@ class DataGenerator(object):
         """采样函数，每个样本同时返回一个is_end标记。
         返回一个迭代器，每次返回一条样本，顺序或者随机打乱。并且同时返回是否为最后一条的标记。
         """
+        epoch = self.epoch
+        if random:
+            self.epoch += 1
+
         if random: #如果random随机为True
             if self.steps is None: #且总步数为None。（不成立）
 
+                def pop_random(caches):
+                    # 随机位置与末尾交换后再pop，O(1)
+                    i = self.rng.randint(len(caches))
+                    caches[i], caches[-1] = caches[-1], caches[i]
+                    return caches.pop()
+
                 def generator():
                     caches, isfull = [], False
-                    for d in self.data:
+                    for d in self.shard_stream():
                         caches.append(d)
                         if isfull:
-                            i = np.random.randint(len(caches))
-                            yield caches.pop(i)
+                            yield pop_random(caches)
                         elif len(caches) == self.buffer_size:
                             isfull = True
                     while caches:
-                        i = np.random.randint(len(caches))
-                        yield caches.pop(i)
+                        yield pop_random(caches)
 
             else: #总步数不为None
                 def generator():#定义generator函数
-                    indices = list(range(len(self.data))) #对所有样本编号，1-n
-                    np.random.shuffle(indices) #随机打乱编号
+                    if self.num_shards > 1:  #本epoch本分片的样本编号，已随机打乱
+                        indices = self.shard_indices(len(self.data), epoch)
+                    else:
+                        indices = list(range(len(self.data))) #对所有样本编号，1-n
+                        self.rng.shuffle(indices) #随机打乱编号
                     for i in indices: #生成迭代器，每次返回一个样本。
                         yield self.data[i]
 
             data = generator() #data等于迭代器，每次随机返回一个元素。
+            if self.bucket_by is not None and self.max_tokens is None:
+                data = self.bucketing(data)
+        elif self.steps is None or self.num_shards == 1:
+            data = iter(self.shard_stream()) #data顺次返回一个元素。iter对容器包装返回一个迭代器
         else:
-            data = iter(self.data) #data顺次返回一个元素。iter对容器包装返回一个迭代器
+            data = (self.data[i] for i in self.shard_indices(len(self.data)))
         #data是一个迭代器，每次返回一条样本。（random为True就随机返回，false就顺序返回）
-        
+
+        if self.max_tokens is not None:  # 动态batch时is_end标记每个batch的结尾
+            for d in self.token_batching(data, random, epoch):
+                yield d
+            return
+
         d_current = next(data) #当前元素为d_current
         for d_next in data: #对data中的每一个元素，返回false和当前元素
             yield False, d_current
             d_current = d_next #令当前元素等于下一个元素。
         yield True, d_current #返回True和当前元素。
 
+    def shard_stream(self):
+        """流式读取本分片的数据（按位置间隔切片）
+        """
+        if self.num_shards == 1:
+            return self.data
+        return itertools.islice(
+            self.data, self.shard_index, None, self.num_shards
+        )
+
+    def shard_indices(self, size, epoch=None):
+        """本分片的下标：epoch非None时所有分片先用(seed, epoch)得到同一个
+        随机排列，再按分片间隔切片，保证各分片互不重叠；even_shards时先
+        循环补齐到num_shards的整数倍，使各分片长度相同
+        """
+        if epoch is None:
+            indices = np.arange(size)
+        else:
+            rng = np.random.RandomState([self.seed, epoch])
+            indices = rng.permutation(size)
+        if self.even_shards and size % self.num_shards:
+            total = -(-size // self.num_shards) * self.num_shards
+            indices = np.resize(indices, total)  # 循环重复开头的下标
+        return indices[self.shard_index::self.num_shards]
+
+    def bucketing(self, data):
+        """分桶：按块读取样本，块内按bucket_by排序后切成batch并打乱batch顺序
+        每块的大小是batch_size的整数倍，所以只有最后一块可能出现不满的
+        batch，将其放在最后，保证子类按batch_size切分时batch边界不变。
+        """
+        chunk_size = self.batch_size * self.bucket_chunk
+        chunk = []
+        for d in data:
+            chunk.append(d)
+            if len(chunk) == chunk_size:
+                for d in self.sort_chunk(chunk):
+                    yield d
+                chunk = []
+        for d in self.sort_chunk(chunk):
+            yield d
+
+    def sort_chunk(self, chunk):
+        """对一块样本排序分batch，并累计padding统计
+        """
+        if not chunk:
+            return []
+        lengths = np.array([self.bucket_by(d) for d in chunk])
+        splits = list(range(self.batch_size, len(chunk), self.batch_size))
+        batches = np.split(np.argsort(lengths, kind='mergesort'), splits)
+        num_full = len(batches) - int(len(batches[-1]) < self.batch_size)
+        orders = list(self.rng.permutation(num_full))
+        orders += list(range(num_full, len(batches)))  # 不满的batch放最后
+        batches = [batches[i] for i in orders]
+        self.record_padding(lengths, batches, np.arange(len(chunk)))
+        return [chunk[i] for batch in batches for i in batch]
+
+    def record_padding(self, lengths, batches, order):
+        """累计padding统计，对照为按order顺序每batch_size个样本一个batch
+        """
+        splits = list(range(self.batch_size, len(order), self.batch_size))
+        self.padding_stats['tokens'] += int(lengths[order].sum())
+        self.padding_stats['padded'] += self.padded_size(lengths, batches)
+        self.padding_stats['unbucketed'] += self.padded_size(
+            lengths, np.split(order, splits)
+        )
+
+    def token_budget_batches(self, lengths):
+        """按长度排序后贪心地划分动态batch，返回各batch的样本下标
+        每个batch满足：样本数不超过batch_size，样本数×最大长度不超过
+        max_tokens（单个样本超出预算时单独成batch）；样本数尽量取
+        batch_size_multiple的整数倍，多出的样本顺延到下一个batch。
+        """
+        multiple, batches, batch = self.batch_size_multiple, [], []
+        for i in np.argsort(lengths, kind='mergesort'):
+            while batch and (
+                len(batch) + 1 > self.batch_size or
+                (len(batch) + 1) * lengths[i] > self.max_tokens
+            ):
+                num = multiple * (len(batch) // multiple)
+                num = max(num, len(batch) % multiple)
+                batches.append(np.array(batch[:num]))
+                batch = batch[num:]
+            batch.append(i)
+        if batch:
+            batches.append(np.array(batch))
+        return batches
+
+    def token_batching(self, data, random, epoch=0):
+        """动态batch采样，每个batch的最后一个样本的is_end标记为True
+        """
+        if self.token_batches is not None:
+            batches = self.token_batches
+            if self.num_shards > 1:
+                if random:
+                    orders = self.shard_indices(len(batches), epoch)
+                else:
+                    orders = self.shard_indices(len(batches))
+                batches = [batches[i] for i in orders]
+            chunks = [(self.data, self.token_lengths, batches)]
+        else:
+            chunks = self.token_batching_chunks(data)
+
+        for chunk, lengths, batches in chunks:
+            if random:
+                orders = self.rng.permutation(len(batches))
+                batches = [batches[i] for i in orders]
+            if batches:  # 对照为按原顺序的固定batch_size
+                order = np.sort(np.concatenate(batches))
+                self.record_padding(lengths, batches, order)
+            for batch in batches:
+                for j, i in enumerate(batch):
+                    yield j == len(batch) - 1, chunk[i]
+
+    def token_batching_chunks(self, data):
+        """流式数据按块划分动态batch
+        """
+        chunk_size = self.batch_size * self.bucket_chunk
+        chunk = []
+        for d in data:
+            chunk.append(d)
+            if len(chunk) == chunk_size:
+                lengths = np.array([self.bucket_by(d) for d in chunk])
+                yield chunk, lengths, self.token_budget_batches(lengths)
+                chunk = []
+        if chunk:
+            lengths = np.array([self.bucket_by(d) for d in chunk])
+            yield chunk, lengths, self.token_budget_batches(lengths)
+
+    @staticmethod
+    def padded_size(lengths, batches):
+        """各batch补齐到batch内最大长度后的总token数
+        """
+        return int(sum(lengths[b].max() * len(b) for b in batches))
+
+    def padding_saved(self):
+        """分桶相比不分桶节省的padding token比例（按已采样的数据统计）
+        """
+        stats = self.padding_stats
+        unbucketed_padding = stats['unbucketed'] - stats['tokens']
+        if unbucketed_padding <= 0:
+            return 0.
+        padding = stats['padded'] - stats['tokens']
+        return 1. - float(padding) / unbucketed_padding
+
     def __iter__(self, random=False): #需要继承类自定义的方法，定义接受参数为random=False
         raise NotImplementedError
 
-    def forfit(self): 
-        while True:
-            for d in self.__iter__(True): #对生成的迭代器遍历，返回一个batch的值。
+    def forfit(self, prefetch=None, workers=1, use_processes=False, seed=None):
+        """无限循环地返回训练batch，用于fit_generator
+        参数：
+            prefetch: 非None时在后台预取batch，预取队列的总容量为prefetch；
+            workers: 预取的线程数（use_processes为True时为进程数），各worker
+                     轮流负责一个完整的epoch，按epoch顺序取出，所以batch顺序
+                     与worker数无关；
+            seed: 第i个epoch用seed + i初始化随机数，batch顺序可复现。预取
+                  时若seed为None，则从self.rng中抽取一个。
+        说明：多进程依赖fork（Linux），否则需要生成器对象可以被pickle。
+              生成器被关闭（如fit_generator结束）时后台worker会随之退出。
+        """
+        if prefetch is None:
+            epoch = 0
+            while True:
+                for d in self.epoch_iter(epoch, seed): #对生成的迭代器遍历，返回一个batch的值。
+                    yield d
+                epoch += 1
+        else:
+            if seed is None:
+                seed = self.rng.randint(2**31 - 1)
+            for d in self.prefetch(prefetch, workers, use_processes, seed):
                 yield d
 
+    def epoch_iter(self, epoch, seed=None):
+        """第epoch个epoch的随机batch迭代器，seed非None时使用独立的随机数
+        """
+        if seed is None:
+            self.epoch = epoch
+            return self.__iter__(True)
+        generator = copy.copy(self)
+        generator.rng = np.random.RandomState(seed + epoch)
+        generator.epoch = epoch
+        return generator.__iter__(True)
+
+    def prefetch(self, prefetch, workers, use_processes, seed):
+        """后台预取batch，见forfit
+        """
+        if use_processes:
+            from multiprocessing import Process as Worker, Queue, Event
+        else:
+            from threading import Thread as Worker, Event
+            from six.moves.queue import Queue
+
+        queues = [Queue(max(prefetch // workers, 1)) for _ in range(workers)]
+        stop = Event()
+
+        def put(queue, item):
+            # 队列满时定期检查是否需要退出
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except six.moves.queue.Full:
+                    pass
+            return False
+
+        def worker_loop(index):
+            epoch = index
+            try:
+                while not stop.is_set():
+                    for d in self.epoch_iter(epoch, seed):
+                        if not put(queues[index], d):
+                            return
+                    if not put(queues[index], None):  # None标记epoch结束
+                        return
+                    epoch += workers
+            except Exception as e:
+                put(queues[index], e)
+
+        pool = [Worker(target=worker_loop, args=(i,)) for i in range(workers)]
+        for worker in pool:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            epoch = 0
+            while True:
+                d = queues[epoch % workers].get()
+                if d is None:
+                    epoch += 1
+                elif isinstance(d, Exception):
+                    raise d
+                else:
+                    yield d
+        finally:
+            stop.set()
+            for worker in pool:
+                if use_processes:
+                    worker.terminate()
+                worker.join()
+
 class ViterbiDecoder(object):
     """Viterbi解码算法基类
     """
@@ -319,22 +707,77 @@ class ViterbiDecoder(object):
     def decode(self, nodes):
         """nodes.shape=[seq_len, num_labels]
         """
+        return self.decode_batch(np.asarray(nodes)[None])[0]
+
+    def decode_batch(self, nodes, lengths=None):
+        """nodes.shape=[batch_size, seq_len, num_labels]
+        lengths为每个序列的有效长度（默认都为seq_len），超出部分的标签为0；
+        动态规划时只记录回溯指针，最后统一回溯一次，不修改输入的nodes。
+        """
+        nodes = np.asarray(nodes)
+        nodes = nodes.astype(np.result_type(nodes.dtype, np.float32))
+        batch_size, seq_len = nodes.shape[:2]
+        if lengths is None:
+            lengths = np.full(batch_size, seq_len, dtype='int64')
+        lengths = np.asarray(lengths, dtype='int64')
+        rows = np.arange(batch_size)
+
         # 预处理
-        nodes[0, self.non_starts] -= np.inf
-        nodes[-1, self.non_ends] -= np.inf
+        nodes[:, 0, self.non_starts] -= np.inf
+        ends = np.maximum(lengths, 1) - 1
+        nodes[rows[:, None], ends[:, None], self.non_ends] -= np.inf
 
         # 动态规划
-        labels = np.arange(self.num_labels).reshape((1, -1))
-        scores = nodes[0].reshape((-1, 1))
-        paths = labels
-        for l in range(1, len(nodes)):
-            M = scores + self.trans + nodes[l].reshape((1, -1))
-            idxs = M.argmax(0)
-            scores = M.max(0).reshape((-1, 1))
-            paths = np.concatenate([paths[:, idxs], labels], 0)
-
-        # 最优路径
-        return paths[:, scores[:, 0].argmax()]
+        scores = nodes[:, 0]
+        pointers = np.zeros(nodes.shape, dtype='int64')
+        for l in range(1, seq_len):
+            M = scores[:, :, None] + self.trans + nodes[:, l, None]
+            pointers[:, l] = M.argmax(1)
+            scores = np.where((l < lengths)[:, None], M.max(1), scores)
+
+        # 回溯最优路径
+        labels = np.zeros((batch_size, seq_len), dtype='int64')
+        labels[rows, ends] = np.where(lengths > 0, scores.argmax(1), 0)
+        for l in range(seq_len - 1, 0, -1):
+            prev = pointers[rows, l, labels[:, l]]
+            labels[:, l - 1] = np.where(l < lengths, prev, labels[:, l - 1])
+        return labels
+
+
+def bio_decode(labels, lengths=None):
+    """BIO标签的实体解码，整个batch一次性向量化完成
+    标签约定：0为O，2k+1为第k类实体的B，2k+2为I；实体从B开始，连续的I
+    都归入该实体（不检查I的类别），不跟在B或I后面的I被忽略。
+    参数：labels为[batch_size, seq_len]的整数数组；lengths为每个样本的
+         有效长度，超出部分视为O。
+    返回：长度为batch_size的列表，每个元素为[(start, end, type), ...]，
+         start和end为实体首尾token的下标（闭区间），type为类别k。
+    """
+    labels = np.asarray(labels)
+    batch_size, seq_len = labels.shape
+    if lengths is not None:
+        mask = np.arange(seq_len)[None] < np.asarray(lengths)[:, None]
+        labels = np.where(mask, labels, 0)
+    # 每行末尾补一个O，展平后实体不会跨行
+    labels = np.concatenate(
+        [labels, np.zeros((batch_size, 1), dtype=labels.dtype)], 1
+    ).ravel()
+    is_begin = labels % 2 == 1
+    is_inside = (labels > 0) & ~is_begin
+    starts = np.flatnonzero(is_begin)
+    # 实体在B之后第一个不是I的位置结束
+    breaks = np.flatnonzero(~is_inside)
+    ends = breaks[np.searchsorted(breaks, starts, side='right')] - 1
+    types = (labels[starts] - 1) // 2
+    rows, starts = np.divmod(starts, seq_len + 1)
+    ends -= rows * (seq_len + 1)
+
+    entities = [[] for _ in range(batch_size)]
+    for i, start, end, t in zip(
+        rows.tolist(), starts.tolist(), ends.tolist(), types.tolist()
+    ):
+        entities[i].append((start, end, t))
+    return entities
 
 
 def softmax(x, axis=-1):
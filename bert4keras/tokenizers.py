@@ -1,20 +1,35 @@
 #! -*- coding: utf-8 -*-
 # 工具函数
 
-import unicodedata, re
+import unicodedata, re, os, io, mmap, json, sys, bisect
+import six
+import threading
+from collections import OrderedDict
+import numpy as np
 from bert4keras.snippets import is_string, is_py2
 from bert4keras.snippets import open
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from bert4keras.snippets import sequence_padding, parallel_apply
+
 
 def load_vocab(dict_path, encoding='utf-8', simplified=False, startswith=None):
     """从bert的词典文件中读取词典
+    说明：如果dict_path是compile_vocab编译得到的文件，则直接以mmap方式
+          加载为CompiledVocab（只读，多进程共享内存页）。
     """
-    token_dict = {}
-    with open(dict_path, encoding=encoding) as reader:
-        for line in reader:
-            token = line.split()
-            token = token[0] if token else line.strip()
-            token_dict[token] = len(token_dict)
+    if is_compiled_vocab(dict_path):
+        token_dict = CompiledVocab(dict_path)
+    else:
+        token_dict = {}
+        with open(dict_path, encoding=encoding) as reader:
+            for line in reader:
+                token = line.split()
+                token = token[0] if token else line.strip()
+                token_dict[token] = len(token_dict)
 
     if simplified:  # 过滤冗余部分token
         new_token_dict, keep_tokens = {}, []
@@ -23,26 +38,244 @@ def load_vocab(dict_path, encoding='utf-8', simplified=False, startswith=None):
             new_token_dict[t] = len(new_token_dict)
             keep_tokens.append(token_dict[t])
 
-        for t, _ in sorted(token_dict.items(), key=lambda s: s[1]):
+        if isinstance(token_dict, CompiledVocab):
+            candidates = token_dict.simplified_items()  # 编译时已完成过滤
+        else:
+            candidates = [
+                (t, i)
+                for t, i in sorted(token_dict.items(), key=lambda s: s[1])
+                if not _is_redundant_token(t)
+            ]
+
+        for t, i in candidates:
             if t not in new_token_dict:
-                keep = True
-                if len(t) > 1:
-                    for c in Tokenizer.stem(t):
-                        if (
-                            Tokenizer._is_cjk_character(c) or
-                            Tokenizer._is_punctuation(c)
-                        ):
-                            keep = False
-                            break
-                if keep:
-                    new_token_dict[t] = len(new_token_dict)
-                    keep_tokens.append(token_dict[t])
+                new_token_dict[t] = len(new_token_dict)
+                keep_tokens.append(i)
 
         return new_token_dict, keep_tokens
     else:
         return token_dict
 
 
+def _is_redundant_token(token):
+    """精简词典时需要过滤的token：长度大于1且词干含有CJK字符或标点
+    """
+    if len(token) > 1:
+        for c in Tokenizer.stem(token):
+            if Tokenizer._is_cjk_character(c) or Tokenizer._is_punctuation(c):
+                return True
+    return False
+
+
+_COMPILED_VOCAB_MAGIC = b'B4KVOCB2'
+
+
+def compile_vocab(dict_path, compiled_path, encoding='utf-8'):
+    """将词典文件编译为二进制格式，供load_vocab/Tokenizer快速加载
+    格式（小端）：magic(8字节), 词表大小n(int64), 各token在字符串区的
+    起止偏移(int64*(n+1)), 精简词典保留标记(uint8*n, 补齐到8字节), utf-8字符串区(补齐到8字节), 前缀树。
+    前缀树：节点数m(int64), 边数e(int64), 各节点的边在边表中的起止位置
+    (int64*(m+1)), 边的字符(int32*e, 每个节点内升序), 边指向的节点
+    (int32*e), 节点对应的token id(int32*m, 不是token结尾时为-1, 补齐到
+    8字节)。0号节点是所有token的根，1号节点是##开头的token去掉##后的根。
+    """
+    token_dict = load_vocab(dict_path, encoding=encoding)
+    tokens = [t for t, _ in sorted(token_dict.items(), key=lambda s: s[1])]
+    encoded = [t.encode('utf-8') for t in tokens]
+    n = len(tokens)
+    offsets = np.zeros(n + 1, dtype='<i8')
+    offsets[1:] = np.cumsum([len(t) for t in encoded])
+    keep = np.array([not _is_redundant_token(t) for t in tokens], 'uint8')
+    keep = np.pad(keep, (0, -n % 8), 'constant')
+    blob = b''.join(encoded)
+    blob += b'\0' * (-len(blob) % 8)
+
+    # 前缀树，按层序给节点编号
+    children, terminals = [{}, {}], [-1, -1]
+    for i, token in enumerate(tokens):
+        roots = [(0, token)]
+        if token[:2] == '##':
+            roots.append((1, token[2:]))
+        for node, chars in roots:
+            for ch in chars:
+                if ord(ch) not in children[node]:
+                    children[node][ord(ch)] = len(children)
+                    children.append({})
+                    terminals.append(-1)
+                node = children[node][ord(ch)]
+            terminals[node] = i
+    edge_starts, edge_chars, edge_nodes = [0], [], []
+    for edges in children:
+        for code in sorted(edges):
+            edge_chars.append(code)
+            edge_nodes.append(edges[code])
+        edge_starts.append(len(edge_chars))
+    m, e = len(children), len(edge_chars)
+    terminals = np.array(terminals + [0] * (-m % 2), dtype='<i4')
+    edge_arrays = [np.array(edge_chars, '<i4'), np.array(edge_nodes, '<i4')]
+    if e % 2:
+        edge_arrays = [np.append(a, np.zeros(1, '<i4')) for a in edge_arrays]
+
+    with io.open(compiled_path, 'wb') as writer:
+        writer.write(_COMPILED_VOCAB_MAGIC)
+        writer.write(np.array([n], dtype='<i8').tobytes())
+        writer.write(offsets.tobytes())
+        writer.write(keep.tobytes())
+        writer.write(blob)
+        writer.write(np.array([m, e], dtype='<i8').tobytes())
+        writer.write(np.array(edge_starts, dtype='<i8').tobytes())
+        writer.write(edge_arrays[0].tobytes())
+        writer.write(edge_arrays[1].tobytes())
+        writer.write(terminals.tobytes())
+
+
+def is_compiled_vocab(dict_path):
+    """判断是否为compile_vocab编译得到的词典文件
+    """
+    if not is_string(dict_path) or not os.path.isfile(dict_path):
+        return False
+    with io.open(dict_path, 'rb') as reader:
+        return reader.read(len(_COMPILED_VOCAB_MAGIC)) == _COMPILED_VOCAB_MAGIC
+
+
+class CompiledVocab(Mapping):
+    """compile_vocab所得词典的只读mmap视图，用法同token_dict
+    token到id的查询和WordPiece的最长匹配都直接在文件中的前缀树上进行，
+    不需要构建dict，所以加载几乎无开销，且fork出的多个worker共享同一份
+    内存页。
+    """
+    def __init__(self, compiled_path):
+        with io.open(compiled_path, 'rb') as reader:
+            self._mmap = mmap.mmap(
+                reader.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        offset = len(_COMPILED_VOCAB_MAGIC)
+        n = int(np.frombuffer(self._mmap, '<i8', 1, offset)[0])
+        offset += 8
+        self._offsets = np.frombuffer(self._mmap, '<i8', n + 1, offset)
+        offset += 8 * (n + 1)
+        self._keep = np.frombuffer(self._mmap, 'uint8', n, offset)
+        offset += n + (-n % 8)
+        self._blob_offset = offset
+        self._size = n
+        offset += int(self._offsets[-1]) + (-int(self._offsets[-1]) % 8)
+        m, e = np.frombuffer(self._mmap, '<i8', 2, offset).tolist()
+        offset += 16
+        self._edge_starts = self._int_view(offset, m + 1, 'q')
+        offset += 8 * (m + 1)
+        self._edge_chars = self._int_view(offset, e, 'i')
+        offset += 4 * (e + e % 2)
+        self._edge_nodes = self._int_view(offset, e, 'i')
+        offset += 4 * (e + e % 2)
+        self._terminals = self._int_view(offset, m, 'i')
+        self.inverse = _CompiledVocabInverse(self)
+
+    def _int_view(self, offset, size, fmt):
+        """文件中的小端整数数组，下标访问直接返回int
+        """
+        if is_py2 or sys.byteorder != 'little':
+            dtype = {'q': '<i8', 'i': '<i4'}[fmt]
+            return np.frombuffer(self._mmap, dtype, size, offset).tolist()
+        nbytes = size * {'q': 8, 'i': 4}[fmt]
+        return memoryview(self._mmap)[offset:offset + nbytes].cast(fmt)
+
+    def _token_bytes(self, i):
+        start = self._blob_offset + int(self._offsets[i])
+        end = self._blob_offset + int(self._offsets[i + 1])
+        return self._mmap[start:end]
+
+    def id_to_token(self, i):
+        """id转换为对应的token
+        """
+        if not 0 <= i < self._size:
+            raise KeyError(i)
+        return self._token_bytes(i).decode('utf-8')
+
+    def _walk(self, node, word, start, end):
+        """从node出发沿word[start:end]在前缀树中逐字符前进，返回沿途经过的
+        节点（遇到不存在的边时停止）
+        """
+        edge_starts, edge_chars = self._edge_starts, self._edge_chars
+        edge_nodes, bisect_left = self._edge_nodes, bisect.bisect_left
+        nodes = []
+        for i in range(start, end):
+            lo, hi = edge_starts[node], edge_starts[node + 1]
+            code = ord(word[i])
+            j = bisect_left(edge_chars, code, lo, hi)
+            if j == hi or edge_chars[j] != code:
+                break
+            node = edge_nodes[j]
+            nodes.append(node)
+        return nodes
+
+    def get(self, token, default=None):
+        if not is_string(token):
+            return default
+        edge_starts, edge_chars = self._edge_starts, self._edge_chars
+        edge_nodes, bisect_left = self._edge_nodes, bisect.bisect_left
+        node = 0
+        for ch in token:
+            lo, hi = edge_starts[node], edge_starts[node + 1]
+            code = ord(ch)
+            j = bisect_left(edge_chars, code, lo, hi)
+            if j == hi or edge_chars[j] != code:
+                return default
+            node = edge_nodes[j]
+        token_id = self._terminals[node] if node else -1
+        return default if token_id < 0 else token_id
+
+    def longest_match(self, word, start, subword=False):
+        """从word[start]开始做最长匹配，返回匹配终点（没有匹配时返回start）
+        subword为True时匹配##开头的token（不含##）。
+        """
+        terminals = self._terminals
+        nodes = self._walk(int(subword), word, start, len(word))
+        for i in range(len(nodes) - 1, -1, -1):
+            if terminals[nodes[i]] >= 0:
+                return start + i + 1
+        return start
+
+    def __getitem__(self, token):
+        i = self.get(token)
+        if i is None:
+            raise KeyError(token)
+        return i
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __iter__(self):
+        for i in range(self._size):
+            yield self.id_to_token(i)
+
+    def __len__(self):
+        return self._size
+
+    def items(self):
+        """按id顺序返回所有(token, id)
+        """
+        return [(self.id_to_token(i), i) for i in range(self._size)]
+
+    def simplified_items(self):
+        """按id顺序返回编译时标记为保留的(token, id)
+        """
+        for i in np.flatnonzero(self._keep):
+            yield self.id_to_token(int(i)), int(i)
+
+
+class _CompiledVocabInverse(object):
+    """CompiledVocab的id到token映射，用法同token_dict_inv
+    """
+    def __init__(self, vocab):
+        self._vocab = vocab
+
+    def __getitem__(self, i):
+        return self._vocab.id_to_token(i)
+
+    def __len__(self):
+        return len(self._vocab)
+
+
 def save_vocab(dict_path, token_dict, encoding='utf-8'):
     """将词典（比如精简过的）保存为文件
     """
@@ -51,6 +284,74 @@ def save_vocab(dict_path, token_dict, encoding='utf-8'):
             writer.write(k + '\n')
 
 
+def tokenize_corpus(
+    tokenizer,
+    corpus,
+    output_path,
+    field=None,
+    maxlen=None,
+    workers=None,
+    max_queue_size=None,
+    encoding='utf-8'
+):
+    """流式地将语料编码为token id，以ragged格式写入磁盘
+    参数：
+        corpus：文件路径（每行一个样本，惰性读取）或者文本的迭代器；
+        field：非None时每行按json解析，取field字段作为文本（跳过空行）；
+        workers：非None时用多进程（parallel_apply）并行编码。
+    输出：output_path + '.bin'为所有样本首尾拼接的int32 token id，
+          output_path + '.idx.npy'为int64的起始偏移，样本顺序与输入一致，
+          用snippets.RaggedArray(output_path)以mmap方式读取。
+    返回：样本数。
+    """
+    def texts():
+        if is_string(corpus):
+            with open(corpus, encoding=encoding) as reader:
+                for line in reader:
+                    if field is None or line.strip():
+                        yield line
+        else:
+            for text in corpus:
+                if field is None or text.strip():
+                    yield text
+
+    def encode(item):
+        i, text = item
+        if field is None:
+            text = text.rstrip('\r\n')
+        else:
+            text = json.loads(text)[field]
+        token_ids = tokenizer.encode(text, maxlen=maxlen)[0]
+        return i, np.array(token_ids, dtype='int32')
+
+    offsets, pending = [0], {}
+
+    with io.open(output_path + '.bin', 'wb') as writer:
+
+        def write(result):
+            # 多进程的输出是无序的，按样本编号依次写入
+            pending[result[0]] = result[1]
+            while len(offsets) - 1 in pending:
+                token_ids = pending.pop(len(offsets) - 1)
+                writer.write(token_ids.tobytes())
+                offsets.append(offsets[-1] + len(token_ids))
+
+        if workers is None:
+            for item in enumerate(texts()):
+                write(encode(item))
+        else:
+            parallel_apply(
+                func=encode,
+                iterable=enumerate(texts()),
+                workers=workers,
+                max_queue_size=max_queue_size or workers * 100,
+                callback=write
+            )
+
+    np.save(output_path + '.idx.npy', np.array(offsets, dtype='int64'))
+    return len(offsets) - 1
+
+
 class BasicTokenizer(object):
     """分词器基类
     """
@@ -64,19 +365,31 @@ class BasicTokenizer(object):
         self._token_start = token_start
         self._token_end = token_end
 
-    def tokenize(self, text, maxlen=None):
+    def tokenize(self, text, maxlen=None, return_mapping=False):
         """分词函数
+        return_mapping为True时，分词的同时记录字符位置，返回
+        (tokens, token_mapping)，token_mapping与rematch的结果格式一致。
         """
-        tokens = self._tokenize(text)       #使用基本分词函数分词，插入头和尾部，补全不足部分。
+        if return_mapping:
+            tokens, mapping = self._tokenize_with_mapping(text)
+        else:
+            tokens = self._tokenize(text)       #使用基本分词函数分词，插入头和尾部，补全不足部分。
+            mapping = []
         if self._token_start is not None:
             tokens.insert(0, self._token_start)
+            mapping.insert(0, [])
         if self._token_end is not None:
             tokens.append(self._token_end)
+            mapping.append([])
 
         if maxlen is not None:
             index = int(self._token_end is not None) + 1
             self.truncate_sequence(maxlen, tokens, None, -index)
+            if return_mapping:
+                self.truncate_sequence(maxlen, mapping, None, -index)
 
+        if return_mapping:
+            return tokens, mapping
         return tokens
 
     def token_to_id(self, token):
@@ -93,18 +406,30 @@ class BasicTokenizer(object):
         self, maxlen, first_sequence, second_sequence=None, pop_index=-1
     ):
         """截断总长度
+        每次从较长的序列中删除pop_index处的元素，直到总长度不超过maxlen；
+        这里先算出两个序列各自要删除的个数，再一次性切片删除。
         """
         if second_sequence is None:
             second_sequence = []
 
-        while True:
-            total_length = len(first_sequence) + len(second_sequence)
-            if total_length <= maxlen:
-                break
-            elif len(first_sequence) > len(second_sequence):
-                first_sequence.pop(pop_index)
+        first_length, second_length = len(first_sequence), len(second_sequence)
+        while first_length + second_length > maxlen:
+            if first_length > second_length:
+                first_length -= 1
             else:
-                second_sequence.pop(pop_index)
+                second_length -= 1
+
+        for sequence, length in [
+            (first_sequence, first_length),
+            (second_sequence, second_length),
+        ]:
+            n = len(sequence) - length
+            if n > 0:
+                if pop_index < 0:
+                    start = max(len(sequence) + pop_index - n + 1, 0)
+                else:
+                    start = pop_index
+                del sequence[start:start + n]
 
     def encode(
         self, first_text, second_text=None, maxlen=None, pattern='S*E*E'
@@ -142,6 +467,96 @@ class BasicTokenizer(object):
         #first_token_ids是token对应id号，segments_ids是0组成的list。
         return first_token_ids, first_segment_ids
 
+    def encode_batch(
+        self,
+        texts,
+        maxlen=None,
+        return_offsets=False,
+        workers=None,
+        max_queue_size=None
+    ):
+        """批量编码，直接返回padding好的int32数组
+        返回：token_ids, segment_ids, lengths；如果return_offsets为True，
+              再额外返回每个样本的token_mapping（见rematch）。
+        说明：workers非None时用多进程并行分词（parallel_apply），适合
+              大批量文本；结果顺序与输入保持一致。
+        """
+        def encode_one(text):
+            if return_offsets:
+                tokens, mapping = self.tokenize(text, maxlen, True)
+                return self.tokens_to_ids(tokens), mapping
+            tokens = self.tokenize(text, maxlen=maxlen)
+            return self.tokens_to_ids(tokens), None
+
+        if workers is None:
+            results = [encode_one(text) for text in texts]
+        else:
+            results = parallel_apply(
+                func=encode_one,
+                iterable=texts,
+                workers=workers,
+                max_queue_size=max_queue_size or workers * 100
+            )
+
+        batch_token_ids = [r[0] for r in results]
+        lengths = np.array([len(i) for i in batch_token_ids], dtype='int32')
+        if batch_token_ids:
+            token_pad_id = getattr(self, '_token_pad_id', 0)
+            token_ids = sequence_padding(
+                batch_token_ids, padding=token_pad_id, dtype='int32'
+            )
+        else:  # 空的batch
+            token_ids = np.zeros((0, 0), dtype='int32')
+        segment_ids = np.zeros_like(token_ids)
+
+        if return_offsets:
+            return token_ids, segment_ids, lengths, [r[1] for r in results]
+        return token_ids, segment_ids, lengths
+
+    def encode_windows(
+        self, text, maxlen=512, stride=None, return_offsets=False
+    ):
+        """长文本的滑动窗口编码（不丢弃超出maxlen的token）
+        每个窗口包含首尾标记，正文部分最多maxlen减去标记数个token，相邻
+        窗口的起点相差stride个token（默认为正文长度的一半），最后一个窗口
+        与全文末尾对齐。
+        返回：token_ids, segment_ids（padding好的int32数组，每行一个窗口），
+              starts（每个窗口正文第一个token在全文token序列中的位置）；
+              如果return_offsets为True，再额外返回全文token序列（不含首尾
+              标记）与原始字符的映射，格式同rematch。
+        """
+        if return_offsets:
+            tokens, mapping = self._tokenize_with_mapping(text)
+        else:
+            tokens = self._tokenize(text)
+
+        head_ids, tail_ids = [], []
+        if self._token_start is not None:
+            head_ids = self.tokens_to_ids([self._token_start])
+        if self._token_end is not None:
+            tail_ids = self.tokens_to_ids([self._token_end])
+        window = maxlen - len(head_ids) - len(tail_ids)
+        stride = stride or max(window // 2, 1)
+
+        last_start = max(len(tokens) - window, 0)
+        starts = list(range(0, last_start, stride)) + [last_start]
+        token_ids = self.tokens_to_ids(tokens)
+        batch_token_ids = [
+            head_ids + token_ids[start:start + window] + tail_ids
+            for start in starts
+        ]
+
+        token_pad_id = getattr(self, '_token_pad_id', 0)
+        batch_token_ids = sequence_padding(
+            batch_token_ids, padding=token_pad_id, dtype='int32'
+        )
+        batch_segment_ids = np.zeros_like(batch_token_ids)
+        starts = np.array(starts, dtype='int32')
+
+        if return_offsets:
+            return batch_token_ids, batch_segment_ids, starts, mapping
+        return batch_token_ids, batch_segment_ids, starts
+
     def id_to_token(self, i):
         """id序列为对应的token
         """
@@ -162,17 +577,31 @@ class BasicTokenizer(object):
         """
         raise NotImplementedError
 
+    def _tokenize_with_mapping(self, text):
+        """基本分词函数，同时返回每个token对应的原始字符位置
+        """
+        raise NotImplementedError
+
 
 class Tokenizer(BasicTokenizer):
     """Bert原生分词器
     纯Python实现，代码修改自keras_bert的tokenizer实现
     """
+    _char_classes = None  # 字符类别查找表，所有实例共享
+
     def __init__(
-        self, token_dict, do_lower_case=False, pre_tokenize=None, **kwargs
+        self,
+        token_dict,
+        do_lower_case=False,
+        pre_tokenize=None,
+        cache_size=None,
+        **kwargs
     ):
         """这里的pre_tokenize是外部传入的分词函数，用作对文本进行预分词。如果传入
         pre_tokenize，则先执行pre_tokenize(text)，然后在它的基础上执行原本的
         tokenize函数。
+        cache_size非None时，为_word_piece_tokenize开启容量为cache_size的LRU
+        缓存（线程安全），命中情况可以通过cache_info()查看。
         """
         super(Tokenizer, self).__init__(**kwargs) #添加五种通用token。
         if is_string(token_dict): #如果token_dict是路径，就加载该token_dict.key是单词，value是对应id。
@@ -181,8 +610,26 @@ class Tokenizer(BasicTokenizer):
         self._do_lower_case = do_lower_case
         self._pre_tokenize = pre_tokenize
         self._token_dict = token_dict
-        self._token_dict_inv = {v: k for k, v in token_dict.items()}
+        if isinstance(token_dict, CompiledVocab):
+            self._token_dict_inv = token_dict.inverse
+        else:
+            self._token_dict_inv = {v: k for k, v in token_dict.items()}
         self._vocab_size = len(token_dict)
+        if isinstance(token_dict, CompiledVocab):
+            # 编译词典自带mmap的前缀树，查询和最长匹配都直接在上面进行
+            self._word_trie, self._subword_trie = None, None
+            self._longest_match = token_dict.longest_match
+        else:
+            # 前缀树在初始化时构建，多进程时fork之前就已存在
+            self._word_trie, self._subword_trie = self._build_trie()
+            self._longest_match = self._trie_longest_match
+        self._token_dict_get = token_dict.get
+        self._id_to_token_table = None  # decode_batch的查找表，首次使用时构建
+        self._id_is_special_table = None
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_hits, self._cache_misses = 0, 0
 
         for token in ['pad', 'unk', 'mask', 'start', 'end']:
             try:
@@ -195,7 +642,10 @@ class Tokenizer(BasicTokenizer):
     def token_to_id(self, token):
         """token转换为对应的id
         """
-        return self._token_dict.get(token, self._token_unk_id)
+        token_id = self._token_dict_get(token)
+        if token_id is None:
+            return self._token_unk_id
+        return token_id
 
     def id_to_token(self, i):
         """id转换为对应的token
@@ -207,29 +657,55 @@ class Tokenizer(BasicTokenizer):
         """
         tokens = tokens or self.ids_to_tokens(ids)
         tokens = [token for token in tokens if not self._is_special(token)]
+        return self._decode_tokens(tokens)
 
-        text, flag = '', False
+    def decode_batch(self, ids_list):
+        """批量转为可读文本
+        ids_list可以是二维数组（如padding过的结果）或者id序列的list，
+        二维数组时通过查表一次性完成id到token的转换。
+        """
+        if self._id_to_token_table is None:
+            tokens = [self.id_to_token(i) for i in range(self._vocab_size)]
+            is_special = [self._is_special(token) for token in tokens]
+            self._id_to_token_table = np.array(tokens, dtype=object)
+            self._id_is_special_table = np.array(is_special)
+        results = []
+        if isinstance(ids_list, np.ndarray) and ids_list.ndim == 2:
+            batch_tokens = self._id_to_token_table[ids_list]
+            batch_keep = ~self._id_is_special_table[ids_list]
+            for tokens, keep in zip(batch_tokens, batch_keep):
+                results.append(self._decode_tokens(tokens[keep].tolist()))
+        else:
+            for ids in ids_list:
+                ids = np.asarray(ids, dtype='int64')
+                tokens = self._id_to_token_table[ids]
+                keep = ~self._id_is_special_table[ids]
+                results.append(self._decode_tokens(tokens[keep].tolist()))
+        return results
+
+    def _decode_tokens(self, tokens):
+        """将（已去掉特殊符号的）token序列拼接为文本
+        """
+        pieces, last = [], ''
         for i, token in enumerate(tokens):
             if token[:2] == '##':
-                text += token[2:]
+                piece = token[2:]
             elif len(token) == 1 and self._is_cjk_character(token):
-                text += token
+                piece = token
             elif len(token) == 1 and self._is_punctuation(token):
-                text += token
-                text += ' '
-            elif i > 0 and self._is_cjk_character(text[-1]):
-                text += token
+                piece = token + ' '
+            elif i > 0 and last and self._is_cjk_character(last):
+                piece = token
             else:
-                text += ' '
-                text += token
+                piece = ' ' + token
+            if piece:
+                pieces.append(piece)
+                last = piece[-1]
 
-        text = re.sub(' +', ' ', text)
-        text = re.sub('\' (re|m|s|t|ve|d|ll) ', '\'\\1 ', text)
-        punctuation = self._cjk_punctuation() + '+-/={(<['
-        punctuation_regex = '|'.join([re.escape(p) for p in punctuation])
-        punctuation_regex = '(%s) ' % punctuation_regex
-        text = re.sub(punctuation_regex, '\\1', text)
-        text = re.sub('(\d\.) (\d)', '\\1\\2', text)
+        text = _multiple_spaces_regex.sub(' ', ''.join(pieces))
+        text = _apostrophe_regex.sub('\'\\1 ', text)
+        text = _punctuation_space_regex.sub('\\1', text)
+        text = _decimal_space_regex.sub('\\1\\2', text)
 
         return text.strip()
 
@@ -248,53 +724,195 @@ class Tokenizer(BasicTokenizer):
         if pre_tokenize and self._pre_tokenize is not None:
             tokens = []
             for token in self._pre_tokenize(text):
-                if token in self._token_dict:
+                if self._token_dict_get(token) is not None:
                     tokens.append(token)
                 else:
                     tokens.extend(self._tokenize(token, False))
             return tokens
 
-        spaced = ''
+        char_classes, spaced = self._get_char_classes(), []
         for ch in text:
-            if self._is_punctuation(ch) or self._is_cjk_character(ch):
-                spaced += ' ' + ch + ' '
-            elif self._is_space(ch):
-                spaced += ' '
-            elif ord(ch) == 0 or ord(ch) == 0xfffd or self._is_control(ch):
-                continue
+            code = ord(ch)
+            if code < 0x10000:
+                char_class = char_classes[code]
             else:
-                spaced += ch
+                char_class = self._char_class(ch)
+            if char_class == 1:
+                spaced.extend((' ', ch, ' '))
+            elif char_class == 2:
+                spaced.append(' ')
+            elif char_class == 0:
+                spaced.append(ch)
 
         tokens = []
-        for word in spaced.strip().split():
+        for word in ''.join(spaced).split():
             tokens.extend(self._word_piece_tokenize(word))
 
         return tokens
 
+    def _tokenize_with_mapping(self, text):
+        """单遍分词并记录字符位置，等价于_tokenize加上rematch
+        """
+        if self._pre_tokenize is not None:
+            tokens = self._tokenize(text)
+            return tokens, self.rematch(text, tokens)
+
+        if is_py2:
+            text = unicode(text)
+
+        if self._do_lower_case:
+            lowered = text.lower()
+            if len(lowered) != len(text):
+                lowered = [ch.lower() for ch in text]
+
+        # 逐字符归一化，每个word记录为(字符列表, 原始位置列表)
+        char_classes, words, word = self._get_char_classes(), [], None
+        for i, ch in enumerate(text):
+            if self._do_lower_case:
+                ch = unicodedata.normalize('NFD', lowered[i])
+                ch = ''.join([
+                    c for c in ch if unicodedata.category(c) != 'Mn'
+                ])
+            for c in ch:
+                code = ord(c)
+                if code < 0x10000:
+                    char_class = char_classes[code]
+                else:
+                    char_class = self._char_class(c)
+                if char_class == 0:
+                    if word is None:
+                        word = ([], [])
+                        words.append(word)
+                    word[0].append(c)
+                    word[1].append(i)
+                elif char_class == 1:
+                    words.append(([c], [i]))
+                    word = None
+                elif char_class == 2:
+                    word = None
+
+        tokens, mapping = [], []
+        for chars, positions in words:
+            offset = 0
+            for token in self._word_piece_tokenize(''.join(chars)):
+                end = offset + len(self.stem(token))
+                tokens.append(token)
+                mapping.append(positions[offset:end])
+                offset = end
+
+        return tokens, mapping
+
+    def _build_trie(self):
+        """由词典构建前缀树，供_word_piece_tokenize做最长匹配
+        说明：word_trie包含所有token（匹配词首）；
+              subword_trie包含##开头的token去掉##后的部分（匹配词中）。
+        """
+        word_trie, subword_trie = {}, {}
+        for token, token_id in self._token_dict.items():
+            self._trie_insert(word_trie, token, token_id)
+            if token[:2] == '##':
+                self._trie_insert(subword_trie, token[2:], token_id)
+        return word_trie, subword_trie
+
+    @staticmethod
+    def _trie_insert(trie, token, token_id):
+        """往前缀树中插入token，None键标记token结束，值为token的id
+        """
+        node = trie
+        for ch in token:
+            node = node.setdefault(ch, {})
+        node[None] = token_id
+
+    def _trie_longest_match(self, word, start, subword=False):
+        """从word[start]开始在前缀树中做最长匹配，返回匹配终点
+        （没有匹配时返回start）；subword为True时在_subword_trie中匹配
+        """
+        node = self._subword_trie if subword else self._word_trie
+        stop = start
+        for i in range(start, len(word)):
+            node = node.get(word[i])
+            if node is None:
+                break
+            if None in node:
+                stop = i + 1
+        return stop
+
+    def cache_info(self):
+        """_word_piece_tokenize的LRU缓存统计
+        """
+        with self._cache_lock:
+            return {
+                'hits': self._cache_hits,
+                'misses': self._cache_misses,
+                'size': len(self._cache),
+                'maxsize': self._cache_size,
+            }
+
     def _word_piece_tokenize(self, word):
         """word内分成subword
         """
-        if word in self._token_dict:
+        if self._token_dict_get(word) is not None:
             return [word]
 
-        tokens = []
-        start, stop = 0, 0
+        if not self._cache_size:
+            return self._word_piece_split(word)
+
+        with self._cache_lock:
+            tokens = self._cache.pop(word, None)
+            if tokens is not None:
+                self._cache[word] = tokens  # 移到最近使用的位置
+                self._cache_hits += 1
+                return list(tokens)
+            self._cache_misses += 1
+
+        tokens = self._word_piece_split(word)
+        with self._cache_lock:
+            self._cache[word] = tuple(tokens)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+        return tokens
+
+    def _word_piece_split(self, word):
+        """基于前缀树的最长匹配切分（不经过缓存）
+        """
+        tokens, start = [], 0
         while start < len(word):
-            stop = len(word)
-            while stop > start:
-                sub = word[start:stop]
-                if start > 0:
-                    sub = '##' + sub
-                if sub in self._token_dict:
-                    break
-                stop -= 1
+            stop = self._longest_match(word, start, start > 0)
             if start == stop:
                 stop += 1
+            sub = word[start:stop]
+            if start > 0:
+                sub = '##' + sub
             tokens.append(sub)
             start = stop
 
         return tokens
 
+    @classmethod
+    def _char_class(cls, ch):
+        """字符归一化时的类别：1为标点或CJK字符（两侧加空格），2为空格，
+        3为需要删除的控制字符，0为普通字符
+        """
+        if cls._is_punctuation(ch) or cls._is_cjk_character(ch):
+            return 1
+        elif cls._is_space(ch):
+            return 2
+        elif ord(ch) == 0 or ord(ch) == 0xfffd or cls._is_control(ch):
+            return 3
+        else:
+            return 0
+
+    @classmethod
+    def _get_char_classes(cls):
+        """BMP范围内各码位的_char_class查找表（首次调用时构建）
+        """
+        if Tokenizer._char_classes is None:
+            Tokenizer._char_classes = bytearray(
+                cls._char_class(six.unichr(i)) for i in range(0x10000)
+            )
+        return Tokenizer._char_classes
+
     @staticmethod
     def stem(token):
         """获取token的“词干”（如果是##开头，则自动去掉##）
@@ -391,6 +1009,15 @@ class Tokenizer(BasicTokenizer):
         return token_mapping
 
 
+# Tokenizer.decode所用的正则，预先编译
+_multiple_spaces_regex = re.compile(' +')
+_apostrophe_regex = re.compile('\' (re|m|s|t|ve|d|ll) ')
+_punctuation_space_regex = re.compile('(%s) ' % '|'.join([
+    re.escape(p) for p in Tokenizer._cjk_punctuation() + '+-/={(<['
+]))
+_decimal_space_regex = re.compile('(\\d\\.) (\\d)')
+
+
 class SpTokenizer(BasicTokenizer):
     """基于SentencePiece模型的封装，使用上跟Tokenizer基本一致。
     """
@@ -411,11 +1038,75 @@ class SpTokenizer(BasicTokenizer):
             except:
                 pass
 
+        # id与piece的互查表，末尾的''对应越界id
+        pieces = [
+            self.sp_model.id_to_piece(i) for i in range(self._vocab_size)
+        ]
+        self._id_to_piece_table = np.array(pieces + [''], dtype=object)
+        self._piece_to_id_dict = {p: i for i, p in enumerate(pieces)}
+
     def token_to_id(self, token):
         """token转换为对应的id
         """
         return self.sp_model.piece_to_id(token)
 
+    def tokens_to_ids(self, tokens):
+        """token序列转换为对应的id序列（查表，不逐个调用sp_model）
+        """
+        unk_id = self.sp_model.unk_id()
+        return [self._piece_to_id_dict.get(token, unk_id) for token in tokens]
+
+    def ids_to_tokens(self, ids):
+        """id序列转换为对应的token序列（numpy查表）
+        """
+        ids = np.asarray(ids, dtype='int64')
+        ids = np.where((ids >= 0) & (ids < self._vocab_size), ids, -1)
+        return self._id_to_piece_table[ids].tolist()
+
+    def encode_batch(
+        self,
+        texts,
+        maxlen=None,
+        return_offsets=False,
+        workers=None,
+        max_queue_size=None
+    ):
+        """批量编码，整批文本通过一次sentencepiece调用直接转为id
+        返回格式与BasicTokenizer.encode_batch一致；return_offsets或者
+        workers非None时退回到逐条分词的实现（return_offsets需要protobuf）。
+        """
+        if return_offsets or workers is not None:
+            return super(SpTokenizer, self).encode_batch(
+                texts, maxlen, return_offsets, workers, max_queue_size
+            )
+
+        texts = list(texts)
+        try:
+            batch_ids = self.sp_model.encode(texts, out_type=int)
+        except TypeError:  # 旧版sentencepiece不支持批量编码
+            batch_ids = [self.sp_model.encode_as_ids(text) for text in texts]
+
+        head_ids, tail_ids = [], []
+        if self._token_start is not None:
+            head_ids = [self._token_start_id]
+        if self._token_end is not None:
+            tail_ids = [self._token_end_id]
+        if maxlen is not None:
+            maxlen = max(maxlen - len(head_ids) - len(tail_ids), 0)
+
+        batch_token_ids = [
+            head_ids + ids[:maxlen] + tail_ids for ids in batch_ids
+        ]
+        lengths = np.array([len(i) for i in batch_token_ids], dtype='int32')
+        if batch_token_ids:
+            token_ids = sequence_padding(
+                batch_token_ids, padding=self._token_pad_id, dtype='int32'
+            )
+        else:  # 空的batch
+            token_ids = np.zeros((0, 0), dtype='int32')
+        segment_ids = np.zeros_like(token_ids)
+        return token_ids, segment_ids, lengths
+
     def id_to_token(self, i):
         """id转换为对应的token
         """
@@ -437,6 +1128,38 @@ class SpTokenizer(BasicTokenizer):
         tokens = self.sp_model.encode_as_pieces(text)
         return tokens
 
+    def _tokenize_with_mapping(self, text):
+        """分词并记录字符位置，由sentencepiece给出的每个piece在原文中的
+        字节区间换算得到（不含空白字符）；需要安装protobuf
+        """
+        try:
+            from sentencepiece import sentencepiece_pb2
+            spt = sentencepiece_pb2.SentencePieceText()
+        except ImportError:
+            raise ImportError(
+                'SpTokenizer needs protobuf for return_mapping/return_offsets, '
+                'please `pip install protobuf`'
+            )
+
+        if is_py2:
+            text = unicode(text)
+
+        spt.ParseFromString(self.sp_model.encode_as_serialized_proto(text))
+        char_index = []  # utf-8字节位置 -> 字符位置
+        for i, ch in enumerate(text):
+            char_index.extend([i] * len(ch.encode('utf-8')))
+        char_index.append(len(text))
+
+        tokens, mapping = [], []
+        for piece in spt.pieces:
+            tokens.append(piece.piece)
+            mapping.append([
+                i for i in range(char_index[piece.begin], char_index[piece.end])
+                if not text[i].isspace()
+            ])
+
+        return tokens, mapping
+
     def _is_special(self, i):
         """判断是不是有特殊含义的符号
         """
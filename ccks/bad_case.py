@@ -10,7 +10,7 @@ Created on Thu Oct  1 12:55:25 2020
 """
 from util import logfile,_init,set_value,get_value
 import os,random
-from preprocess_data import load_data,data_generator
+from preprocess_data import load_data_files,data_generator
 _init()
 from main import train_single_model,build_model
 from bert4keras.tokenizers import Tokenizer
@@ -23,19 +23,11 @@ set_value('checkpoint_path',os.path.join(modeldata_path,r'{}\bert_model.ckpt'.fo
 set_value('dict_path',os.path.join(modeldata_path,r'{}\vocab.txt'.format(path)))
 
 #分割数据集,生成数据集配置。
-data = []           #读取数据集
 data1_path =  r'.\datasets\yidu-s4k\subtask1_training_part1.txt'
 data2_path =  r'.\datasets\yidu-s4k\subtask1_training_part1.txt'
 test_data_path = r'.\datasets\yidu-s4k\subtask1_test_set_with_answer.json'
-with open(data1_path,'r',encoding='gbk') as f:
-    data.extend(f.readlines())
-with open(data2_path,'r',encoding='gbk') as f:
-    data.extend(f.readlines())
-test_data = []
-with open(test_data_path,'r',encoding='gbk') as f:
-    test_data.extend(f.readlines())        
-X = load_data(data)     
-test_data = load_data(test_data)
+X = list(load_data_files([data1_path, data2_path], workers=get_value('data_workers')))     #解析结果缓存到磁盘，之后直接读取
+test_data = list(load_data_files([test_data_path], workers=get_value('data_workers')))
 random.shuffle(X)
 train_data = X[:int(len(X)*0.8)]
 valid_data = X[int(len(X)*0.8):]
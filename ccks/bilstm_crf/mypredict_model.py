@@ -2,7 +2,7 @@
 """
 Created on Wed Sep 30 07:34:35 2020
 """
-from bert4keras.snippets import ViterbiDecoder, to_array  
+from bert4keras.snippets import ViterbiDecoder, to_array, bio_decode
 import numpy as np
 from tqdm import tqdm
 from bert4keras.backend import keras, K
@@ -25,21 +25,8 @@ class NamedEntityRecognizer(object):
         token_ids = to_array(token_ids)       
         nodes = model.predict(token_ids)[0]      #预测该样本，得到的是crf的输出
         labels = np.argmax(nodes,-1)                           #对输出值进行维特比解码。
-        entities, starting = [], False                      
-        for i, label in enumerate(list(labels)):       #根据预测值，生成样本的实体和对应label的tuple对。
-            if label > 0:
-                if label % 2 == 1:
-                    starting = True
-                    entities.append([[i], id2label[(label - 1) // 2]]) #增加这个实体
-                elif starting:
-                    entities[-1][0].append(i)  #该实体对应的下标增长。
-                else:
-                    starting = False  #让开始值保持false
-            else: #如果label为o
-                starting = False
-
-        return [(text[mapping[w[0]][0]:mapping[w[-1]][-1] + 1], l)
-                for w, l in entities]
+        return [(text[mapping[start][0]:mapping[end][-1] + 1], id2label[t])
+                for start, end, t in bio_decode([labels])[0]]   #根据预测值，生成样本的实体和对应label的tuple对。
 
 
 NER = NamedEntityRecognizer()      #ner预测器
@@ -5,15 +5,38 @@ Created on Wed Sep 30 07:31:03 2020
 @author: tunan
 """
 from bert4keras.models import build_transformer_model
-from keras.layers import Dense,TimeDistributed,Bidirectional,LSTM,Dropout
+from keras.layers import Dense,TimeDistributed,Bidirectional,LSTM,Dropout,Lambda
 from keras.models import Model
 from bert4keras.optimizers import Adam
+from bert4keras.backend import K
+from bert4keras.layers import ConditionalRandomField
 from util import logfile,_init,set_value,get_value
 
-def build_model():
+
+def masked_sparse_categorical_crossentropy(y_true, y_pred):
+    '''y_true为整数标签，shape=(batch_size, seq_len, 1)，padding部分为-1，不计入损失。
+    '''
+    y_true = K.cast(y_true[:, :, 0], 'int32')
+    mask = K.cast(K.greater_equal(y_true, 0), K.floatx())
+    loss = K.sparse_categorical_crossentropy(K.maximum(y_true, 0), y_pred)
+    return K.sum(loss * mask, axis=1) / K.maximum(K.sum(mask, axis=1), 1)
+
+
+def masked_sparse_accuracy(y_true, y_pred):
+    '''逐token准确率，排除padding部分。
+    '''
+    y_true = K.cast(y_true[:, :, 0], 'int32')
+    mask = K.cast(K.greater_equal(y_true, 0), K.floatx())
+    y_pred = K.cast(K.argmax(y_pred, -1), 'int32')
+    isequal = K.cast(K.equal(y_true, y_pred), K.floatx())
+    return K.sum(isequal * mask) / K.sum(mask)
+
+
+def build_model(return_tags=False):
     '''加载预训练模型，重新定义模型结构。
-        从bert预训练模型中截取最后一层，接上dense+softmax。
-        返回值：None。model是全局变量，直接修改覆盖。
+        从bert预训练模型中截取最后一层，接上dense+softmax（use_crf时为dense+CRF）。
+        返回值：model；return_tags为True时再返回一个与model共享权重的预测模型，
+        它在计算图内解码（CRF为Viterbi解码，否则为argmax），直接输出int32的标签id。
     '''
     config_path,checkpoint_path,bert_layers,num_labels,learning_rate = get_value('config_path'),get_value('checkpoint_path'),\
         get_value('bert_layers'),get_value('num_labels'),get_value('learning_rate')
@@ -25,16 +48,41 @@ def build_model():
     #模型最后一个transformer输出层的名称。
     output_layer = 'Transformer-%s-FeedForward-Norm' % (bert_layers - 1)
     output = model.get_layer(output_layer).output #得到bert最后一个transformer输出的向量，大小为768.
-    output = Dense(num_labels, activation="softmax")(output)
+    if get_value('use_crf'):
+        output = Dense(num_labels)(output)
+        CRF = ConditionalRandomField(lr_multiplier=get_value('crf_lr_multiplier'))
+        output = CRF(output)
+    else:
+        output = Dense(num_labels, activation="softmax")(output)
     model = Model(model.input, output) #根据输入输出生成模型。
     # model.summary()
     
-    #模型损失使用CRF.sparse_loss,adam学习器，CRF的离散准确率。
-    model.compile(
-        loss='categorical_crossentropy',
-        optimizer=Adam(learning_rate),
-        metrics=['accuracy']
-    )
-    return model
+    #整数标签时使用带mask的稀疏交叉熵和准确率，否则使用one hot标签的交叉熵。
+    if get_value('use_crf'):
+        model.compile(
+            loss=CRF.sparse_loss if get_value('sparse_labels') else CRF.dense_loss,
+            optimizer=Adam(learning_rate),
+            metrics=[CRF.sparse_accuracy if get_value('sparse_labels') else CRF.dense_accuracy]
+        )
+    elif get_value('sparse_labels'):
+        model.compile(
+            loss=masked_sparse_categorical_crossentropy,
+            optimizer=Adam(learning_rate),
+            metrics=[masked_sparse_accuracy]
+        )
+    else:
+        model.compile(
+            loss='categorical_crossentropy',
+            optimizer=Adam(learning_rate),
+            metrics=['accuracy']
+        )
+    if not return_tags:
+        return model
+
+    if get_value('use_crf'):
+        tags = Lambda(CRF.viterbi_decode)(output)
+    else:
+        tags = Lambda(lambda x: K.cast(K.argmax(x, -1), 'int32'))(output)
+    return model, Model(model.input, tags)
 
 #分割训练集和测试集。
@@ -14,6 +14,7 @@ import numpy as np
 from bert4keras.backend import keras, K
 from bert4keras.tokenizers import Tokenizer
 from bert4keras.layers import ConditionalRandomField
+from bert4keras.snippets import IndexedDataset
 from tqdm import tqdm
 from keras_lr_multiplier import LRMultiplier
 from sklearn.model_selection import KFold
@@ -21,7 +22,7 @@ from sgdr_implementation import LR_Cycle
 #加载自定义文件
 from util import logfile,_init,set_value,get_value
 _init()
-from preprocess_data import load_data,data_generator
+from preprocess_data import load_data_files,data_generator,encoded_data_generator,load_encoded_data
 from build_model import build_model
 from predict_model import Evaluator,evaluate
 
@@ -36,10 +37,20 @@ def train_single_model():
     epochs,batch_size,modeldata_path = get_value('epochs'),get_value('batch_size'),get_value('modeldata_path')
     test_data = get_value('test_data')
     train_data = get_value('train_data')
+    train_encoded = get_value('train_encoded')
     global model
     model = build_model()    #定义模型结构
     evaluator = Evaluator() 
-    train_generator = data_generator(train_data, batch_size)
+    if train_encoded is not None:  #已经编码好的训练集，直接切片，不再重复token化
+        train_generator = encoded_data_generator(
+            train_encoded, batch_size, bucket_by=lambda d: len(d[0]),
+            max_tokens=get_value('max_tokens'), batch_size_multiple=8
+        )
+    else:
+        train_generator = data_generator(
+            train_data, batch_size, bucket_by=lambda d: sum(len(w) for w, _ in d),
+            max_tokens=get_value('max_tokens'), batch_size_multiple=8
+        )  #按文本长度分桶，减少padding
 
     sched = LR_Cycle(iterations = len(train_generator),cycle_mult = 2)
     model.fit_generator(
@@ -55,6 +66,8 @@ def train_single_model():
         epochs=epochs,
         callbacks=[evaluator,sched]
     )
+    if train_generator.padding_stats['tokens'] > 0:  #多进程预取时统计留在子进程中
+        print('padding saved by bucketing: %.2f%%' % (100 * train_generator.padding_saved()))
     model.load_weights(os.path.join(modeldata_path,r'model/origin_model.weights'))   #加载模型预测，返回预测值。
     f1, precision, recall = evaluate(test_data,model)
     return f1,precision, recall
@@ -64,27 +77,20 @@ def model_train():
     加载数据集，使用5折交叉验证，返回每个模型在测试集上的f1。
     all_f1(list(float)):5个数据集上的f1值。
     '''    
-    data = []           #读取数据集
     data1_path =  r'.\datasets\yidu-s4k\subtask1_training_part1.txt'
     data2_path =  r'.\datasets\yidu-s4k\subtask1_training_part1.txt'
     test_data_path = r'.\datasets\yidu-s4k\subtask1_test_set_with_answer.json'
-    with open(data1_path,'r',encoding='gbk') as f:
-        data.extend(f.readlines())
-    with open(data2_path,'r',encoding='gbk') as f:
-        data.extend(f.readlines())
-    test_data = []
-    with open(test_data_path,'r',encoding='gbk') as f:
-        test_data.extend(f.readlines())        
-
-    X = load_data(data)     #分割数据集
-    test_data = load_data(test_data) 
+    X = list(load_data_files([data1_path, data2_path], workers=get_value('data_workers')))     #分割数据集，解析结果缓存到磁盘
+    X_encoded = load_encoded_data(X)   #整个数据集只编码一次，缓存到磁盘
+    test_data = list(load_data_files([test_data_path], workers=get_value('data_workers')))
     set_value('test_data',test_data)
     kf = KFold(n_splits=5,shuffle = True)
     all_f1 = []
     for train_index, val_index in kf.split(X):
-        train_data = list(np.array(X)[train_index])
-        valid_data = list(np.array(X)[val_index])   
+        train_data = IndexedDataset(X, train_index)   #各折只保存下标，不复制样本
+        valid_data = IndexedDataset(X, val_index)
         set_value('train_data', train_data)
+        set_value('train_encoded', IndexedDataset(X_encoded, train_index))
         set_value('valid_data',valid_data)
         f1,_,_ = train_single_model()   #训练模型
         all_f1.append(f1)
@@ -2,10 +2,11 @@
 """
 Created on Wed Sep 30 07:34:35 2020
 """
-from bert4keras.snippets import ViterbiDecoder, to_array  
+from bert4keras.snippets import ViterbiDecoder, to_array, sequence_padding, bio_decode
 import numpy as np
 from tqdm import tqdm
 from bert4keras.backend import keras, K
+from bert4keras.layers import ConditionalRandomField
 import os 
 from util import logfile,_init,set_value,get_value
 
@@ -13,72 +14,116 @@ from util import logfile,_init,set_value,get_value
 class NamedEntityRecognizer(object):
     """命名实体识别器
     """
+    def merge_windows(self, starts, nodes, length):
+        '''将各窗口的输出(含cls和sep)拼回全文，重叠部分的输出取平均。
+        返回：整篇文本每个位置的输出，首尾为第一个窗口的cls和最后一个窗口的sep。
+        '''
+        window = get_value('maxlen') - 2
+        scores = np.zeros((length + 2, nodes[0].shape[-1]))
+        counts = np.zeros((length + 2, 1))
+        for start, node in zip(starts, nodes):
+            size = min(window, length - start)
+            scores[start + 1:start + size + 1] += node[1:size + 1]
+            counts[start + 1:start + size + 1] += 1
+        scores[0] = nodes[0][0]
+        scores[-1] = nodes[-1][min(window, length - starts[-1]) + 1]   # 最后一个窗口与全文末尾对齐
+        return scores / np.maximum(counts, 1)
+
+    def decode_labels(self, scores, model):
+        '''输入merge_windows的输出的列表，返回对应的label序列（首尾的cls和sep为0）。
+        use_crf时用CRF层的转移矩阵整批做Viterbi解码，否则逐位置取argmax。
+        '''
+        if get_value('use_crf'):
+            CRF = [l for l in model.layers if isinstance(l, ConditionalRandomField)][0]
+            decoder = ViterbiDecoder(trans=K.eval(CRF.trans), starts=[0], ends=[0])
+            lengths = [len(s) for s in scores]
+            labels = decoder.decode_batch(sequence_padding(scores), lengths)
+            return [l[:n] for l, n in zip(labels, lengths)]
+        labels = []
+        for s in scores:
+            l = np.argmax(s, -1)
+            l[0], l[-1] = 0, 0
+            labels.append(l)
+        return labels
+
+    def predict_labels(self, text, model):
+        '''长文本按maxlen的滑动窗口切分后一次性预测，重叠部分的输出取平均。
+        返回：整篇文本的label序列和token到原文字符的映射（首尾为cls和sep）。
+        '''
+        tokenizer = get_value('tokenizer')
+        token_ids, segment_ids, starts, mapping = tokenizer.encode_windows(
+            text, maxlen=get_value('maxlen'), return_offsets=True
+        )                                                   # 每个窗口都带cls和sep，mapping不含首尾。
+        nodes = model.predict([token_ids, segment_ids])     # 所有窗口放在一个batch中预测
+        scores = self.merge_windows(starts, nodes, len(mapping))
+        return self.decode_labels([scores], model)[0], [[]] + mapping + [[]]
+
+    def extract_entities(self, text, spans, mapping):
+        '''根据bio_decode得到的实体下标，生成样本的实体和对应label的tuple对。
+        '''
+        id2label = get_value('id2label')
+        return [(text[mapping[start][0]:mapping[end][-1] + 1], id2label[t])
+                for start, end, t in spans]
+
     def recognize(self, text,model):
         '''输入一条样本，返回实体和标签的列表。
         '''                   
-        tokenizer,id2label = get_value('tokenizer'),get_value('id2label')
-        tokens = tokenizer.tokenize(text)                  # 对其token化,转换成列表，且加入头部和尾部。输出的依然是字。
-        while len(tokens) > 512:                           #tokens截断到最大512.   
-            tokens.pop(-2)
-        mapping = tokenizer.rematch(text, tokens)       #重新匹配，句子和token序列。
-        token_ids = tokenizer.tokens_to_ids(tokens)     #转换成id序列。
-        segment_ids = [0] * len(token_ids)              #生成分区id。
-        token_ids, segment_ids = to_array([token_ids], [segment_ids])       
-        nodes = model.predict([token_ids, segment_ids])[0]      #预测该样本，得到的是crf的输出
-        labels = np.argmax(nodes,-1)                           #对输出值进行维特比解码。
-        entities, starting = [], False                      
-        for i, label in enumerate(list(labels)):       #根据预测值，生成样本的实体和对应label的tuple对。
-            if label > 0:
-                if label % 2 == 1:
-                    starting = True
-                    entities.append([[i], id2label[(label - 1) // 2]])
-                elif starting:
-                    entities[-1][0].append(i)
-                else:
-                    starting = False
-            else:
-                starting = False
+        labels, mapping = self.predict_labels(text, model)    # 滑动窗口预测整篇文本，不再截断到512。
+        return self.extract_entities(text, bio_decode([labels])[0], mapping)
+
+    def recognize_batch(self, texts, model, batch_size=32):
+        '''输入多条样本，返回与texts顺序一致的实体列表的列表。
+        所有文本的滑动窗口按长度排序后每batch_size个padding到同一长度预测，
+        再按窗口所属的文本拼回全文。
+        '''
+        tokenizer, maxlen = get_value('tokenizer'), get_value('maxlen')
+        windows, mappings, starts = [], [], []   # windows: (文本序号, 窗口序号, token_ids)
+        for i, text in enumerate(texts):
+            token_ids, _, text_starts, mapping = tokenizer.encode_windows(
+                text, maxlen=maxlen, return_offsets=True
+            )
+            for j, start in enumerate(text_starts):
+                length = min(maxlen - 2, len(mapping) - start) + 2   # 去掉padding
+                windows.append((i, j, token_ids[j, :length]))
+            mappings.append(mapping)
+            starts.append(text_starts)
+
+        windows.sort(key=lambda w: len(w[2]))    # 长度相近的窗口放在同一batch，减少padding
+        nodes = [[None] * len(s) for s in starts]
+        for k in range(0, len(windows), batch_size):
+            batch = windows[k:k + batch_size]
+            batch_token_ids = sequence_padding([w[2] for w in batch])
+            batch_segment_ids = np.zeros_like(batch_token_ids)
+            batch_nodes = model.predict([batch_token_ids, batch_segment_ids])
+            for (i, j, token_ids), node in zip(batch, batch_nodes):
+                nodes[i][j] = node[:len(token_ids)]
+
+        scores = [self.merge_windows(text_starts, text_nodes, len(mapping))
+                  for text_starts, text_nodes, mapping in zip(starts, nodes, mappings)]
+        labels = self.decode_labels(scores, model)
+        spans = bio_decode(sequence_padding(labels), [len(l) for l in labels])   # 整个数据集一次解码
+        results = [self.extract_entities(text, text_spans, [[]] + mapping + [[]])
+                   for text, text_spans, mapping in zip(texts, spans, mappings)]
+        return results
 
-        return [(text[mapping[w[0]][0]:mapping[w[-1]][-1] + 1], l)
-                for w, l in entities]
     def recognize1(self, text,model):
         '''输入一条样本，返回实体和标签的列表。
         '''                   
-        tokenizer,id2label = get_value('tokenizer'),get_value('id2label')
-        tokens = tokenizer.tokenize(text)                  # 对其token化,转换成列表，且加入头部和尾部。输出的依然是字。
-        while len(tokens) > 512:                           #tokens截断到最大512.   
-            tokens.pop(-2)
-        mapping = tokenizer.rematch(text, tokens)       #重新匹配，句子和token序列。
-        token_ids = tokenizer.tokens_to_ids(tokens)     #转换成id序列。
-        segment_ids = [0] * len(token_ids)              #生成分区id。
-        token_ids, segment_ids = to_array([token_ids], [segment_ids])       
-        nodes = model.predict([token_ids, segment_ids])[0]      #预测该样本，得到的是crf的输出
-        labels = np.argmax(nodes,-1)                           #对输出值进行维特比解码。
-        entities, starting = [], False                      
-        for i, label in enumerate(list(labels)):       #根据预测值，生成样本的实体和对应label的tuple对。
-            if label > 0:
-                if label % 2 == 1:
-                    starting = True
-                    entities.append([[i], id2label[(label - 1) // 2]])
-                elif starting:
-                    entities[-1][0].append(i)
-                else:
-                    starting = False
-            else:
-                starting = False
-
-        return [(text[mapping[w[0]][0]:mapping[w[-1]][-1] + 1], l,mapping[w[0]][0],mapping[w[-1]][-1]+1)
-                for w, l in entities]
+        id2label = get_value('id2label')
+        labels, mapping = self.predict_labels(text, model)    # 滑动窗口预测整篇文本，不再截断到512。
+        return [(text[mapping[start][0]:mapping[end][-1] + 1], id2label[t],mapping[start][0],mapping[end][-1]+1)
+                for start, end, t in bio_decode([labels])[0]]
 
 
 NER = NamedEntityRecognizer()      #ner预测器
-def evaluate(data,model):  #评测函数data为验证集数据。数据形式为list
+def evaluate(data,model,batch_size=32):  #评测函数data为验证集数据。数据形式为list
     """评测函数
     """
     X, Y, Z = 1e-10, 1e-10, 1e-10
-    for d in tqdm(data): #得到每条数据
-        text = ''.join([i[0] for i in d]) #将文本部分拼接起来。
-        R = set(NER.recognize(text,model))              #输入文本和模型，返回预测的实体
+    texts = [''.join([i[0] for i in d]) for d in data] #将文本部分拼接起来。
+    predictions = NER.recognize_batch(texts, model, batch_size)   #按batch预测所有文本的实体
+    for d, entities in zip(data, predictions): #得到每条数据
+        R = set(entities)              #预测的实体
         T = set([tuple(i) for i in d if i[1] != 'O'])  #得到实体和对应label tuple对(实体文本，label)。即使该实体出现多次，只要有一个预测准确就可以了。
         X += len(R & T)                                  #计算所有预测准确的实体数。
         Y += len(R)                                      #计算所有预测为实体的个数。
@@ -4,9 +4,10 @@ Created on Wed Sep 30 06:57:03 2020
 
 @author: tunan
 """
-import json,os
+import json,os,hashlib
+import numpy as np
 from tqdm import tqdm
-from bert4keras.snippets import sequence_padding, DataGenerator
+from bert4keras.snippets import sequence_padding, DataGenerator, RaggedArray, parallel_apply
 from keras.utils.np_utils import to_categorical
 from util import _init,set_value,get_value
 from bert4keras.tokenizers import Tokenizer
@@ -37,60 +38,211 @@ def add_O(wordlabel,length):
     return wordlabel
 
 
+def _label_type(x):
+    d = {'实验室检验':'检验','影像检查':'检查'}
+    return d.get(x,x)
+
+
+def parse_sample(line):
+    '''输入:line(str),数据集中的一行json。
+        输出:(text,starts,ends,labels),原句以及按起始位置排好序的各片段(含O片段)的起止位置和类型。
+    '''
+    x = json.loads(line)
+    sentences = x['originalText']
+    wordlabel = sorted(x['entities'],key = lambda x:x['start_pos'])
+    wordlabel = add_O(wordlabel,len(sentences))  #添加不是实体的部分文本。
+    starts = [x['start_pos'] for x in wordlabel]
+    ends = [x['end_pos'] for x in wordlabel]
+    labels = [_label_type(x['label_type']) for x in wordlabel]
+    return sentences, starts, ends, labels
+
+
 def load_data(data):
     '''输入(list(str)):
         输出(list(str1,str2)):所有样本的标注数据。str1是句子实体，str2是实体类型。
         给定数据集数据，加载样本。
     '''
-    def f(x):
-        d = {'实验室检验':'检验','影像检查':'检查'}
-        return d.get(x,x)
-    
     D = []
     for line in tqdm(data):
-        x = json.loads(line)  
-        sentences = x['originalText']
-        length = len(sentences)
-        wordLabel = x['entities']
-        wordlabel = sorted(wordLabel,key = lambda x:x['start_pos'])  
-        wordlabel = add_O(wordlabel,length)  #添加不是实体的部分文本。
-        
-        d = []
-        for x in wordlabel:
-            i_beg,i_end = x['start_pos'],x['end_pos']
-            word = sentences[i_beg:i_end]
-            d.append([word,f(x['label_type'])])
-        D.append(d)
+        sentences, starts, ends, labels = parse_sample(line)
+        D.append([[sentences[i1:i2], l] for i1, i2, l in zip(starts, ends, labels)])
     return D
 
+
+class SegmentData(object):
+    """load_data结果的列式缓存，由load_data_files生成。
+    原句按utf-8字节、片段起止位置和类型id分别存为RaggedArray，类型名另存为json，
+    第i条按需还原为与load_data相同的[[片段文本,类型],...]。
+    """
+    def __init__(self, path):
+        self.texts = RaggedArray(path + '.text', 'uint8')
+        self.starts = RaggedArray(path + '.starts')
+        self.ends = RaggedArray(path + '.ends')
+        self.label_ids = RaggedArray(path + '.label_ids')
+        with open(path + '.label_names.json', encoding='utf-8') as f:
+            self.label_names = json.load(f)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, i):
+        sentences = self.texts[i].tobytes().decode('utf-8')
+        return [[sentences[i1:i2], self.label_names[l]] for i1, i2, l in
+                zip(self.starts[i].tolist(), self.ends[i].tolist(), self.label_ids[i].tolist())]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def load_data_files(paths, encoding='gbk', workers=None, cache_dir='./cache'):
+    '''输入:paths(list(str)),若干jsonl数据文件;workers(int),非None时用多进程解析。
+        输出:SegmentData,依次包含各文件的所有样本,第i条与load_data的输出相同。
+        惰性地逐行读取文件，json解析和片段切分在worker进程中进行，结果按原顺序写成列式缓存；
+        之后再次加载相同的文件时直接读取缓存，不再解析json。
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    md5 = hashlib.md5(encoding.encode('utf-8'))
+    for data_path in paths:
+        with open(data_path, 'rb') as f:
+            md5.update(f.read())
+    path = os.path.join(cache_dir, 'segments_' + md5.hexdigest())
+    if os.path.exists(path + '.label_names.json'):
+        return SegmentData(path)
+
+    def lines():
+        for data_path in paths:
+            with open(data_path, 'r', encoding=encoding) as f:
+                for line in f:
+                    if line.strip():
+                        yield line
+
+    def parse(item):
+        i, line = item
+        return i, parse_sample(line)
+
+    label_names = ['O']
+    label2id = {'O': 0}
+    texts, starts, ends, label_ids, pending = [], [], [], [], {}
+
+    def write(result):
+        # 多进程的输出是无序的，按样本编号依次收集
+        pending[result[0]] = result[1]
+        while len(texts) in pending:
+            sentences, i1, i2, labels = pending.pop(len(texts))
+            for l in labels:
+                if l not in label2id:
+                    label2id[l] = len(label_names)
+                    label_names.append(l)
+            texts.append(np.frombuffer(sentences.encode('utf-8'), dtype='uint8'))
+            starts.append(i1)
+            ends.append(i2)
+            label_ids.append([label2id[l] for l in labels])
+
+    if workers is None:
+        for item in enumerate(tqdm(lines())):
+            write(parse(item))
+    else:
+        parallel_apply(
+            func=parse,
+            iterable=enumerate(tqdm(lines())),
+            workers=workers,
+            max_queue_size=workers * 100,
+            callback=write
+        )
+
+    RaggedArray.save(path + '.text', texts, 'uint8')
+    RaggedArray.save(path + '.starts', starts)
+    RaggedArray.save(path + '.ends', ends)
+    RaggedArray.save(path + '.label_ids', label_ids)
+    with open(path + '.label_names.json', 'w', encoding='utf-8') as f:  #最后写入，作为缓存完整的标记
+        json.dump(label_names, f, ensure_ascii=False)
+    return SegmentData(path)
+
+
+def encode_sample(item):
+    '''输入:item(list(str1,str2)),一条样本的(文本片段,实体类型)列表。
+        输出:token_ids(list(int)),labels(list(int)),加上首尾标记后的字id和BIO标签id。
+    '''
+    tokenizer,label2id = get_value('tokenizer'),get_value('label2id')
+    token_ids, labels = [tokenizer._token_start_id], [0] #cls的id和0
+    for w, l in item:  #一条样本中的，每个word和label。
+        w_token_ids = tokenizer.encode(w)[0][1:-1]  #对每段单词编码，得到所有字的id。
+        if len(token_ids) + len(w_token_ids) < get_value('maxlen'): #如果已有的字小于最大长度，就加上当前id。
+            token_ids += w_token_ids
+            if l == 'O': #如果label为O，labels就直接增加对应长度的0。
+                labels += [0] * len(w_token_ids)
+            else:
+                B = label2id[l] * 2 + 1 #否则就对应到它的开头和中间部分，
+                I = label2id[l] * 2 + 2
+                labels += ([B] + [I] * (len(w_token_ids) - 1))
+        else:
+            break
+
+    #得到每个样本的字id和label id，长度等于句子长度。token_ids,labels
+    #如果有一个实体正好在最大长度处卡断了，就去除整个实体。
+    token_ids += [tokenizer._token_end_id]
+    labels += [0]                        #输入和输出都加上结束符。label的开始符和结束符都为0。
+    return token_ids, labels
+
+
+class EncodedData(object):
+    """编码结果的mmap缓存，第i条为(token_ids, labels)两个int32数组。
+    """
+    def __init__(self, path):
+        self.token_ids = RaggedArray(path + '.tokens')
+        self.labels = RaggedArray(path + '.labels')
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def __getitem__(self, i):
+        return self.token_ids[i], self.labels[i]
+
+
+def encoded_cache_key(data):
+    '''缓存的key:实际用于编码的tokenizer的词表、maxlen、标签集合、是否小写以及数据本身的md5。
+    '''
+    tokenizer = get_value('tokenizer')
+    md5 = hashlib.md5()
+    md5.update(json.dumps(sorted(tokenizer._token_dict.items()), ensure_ascii=False).encode('utf-8'))
+    config = [get_value('maxlen'), sorted(get_value('label2id').items()),
+              tokenizer._do_lower_case]
+    md5.update(json.dumps(config).encode('utf-8'))
+    md5.update(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+    return md5.hexdigest()
+
+
+def load_encoded_data(data, cache_dir='./cache'):
+    '''输入:data(list(list(str1,str2))),load_data的输出。
+        输出:EncodedData,与data一一对应的编码结果。
+        第一次调用时对整个数据集编码一次并写入cache_dir，之后的epoch和fold直接读取缓存。
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    path = os.path.join(cache_dir, encoded_cache_key(data))
+    if not os.path.exists(path + '.labels.idx.npy'):
+        encoded = [encode_sample(item) for item in tqdm(data)]
+        RaggedArray.save(path + '.tokens', [e[0] for e in encoded])
+        RaggedArray.save(path + '.labels', [e[1] for e in encoded])
+    return EncodedData(path)
+
+
 #继承了自定义的DataGenerator
 class data_generator(DataGenerator):
     """数据生成器
     初始化函数输入：data(list(str1,str2)),batch_size(int)。data是所有训练数据的集合，batch_size为样本大小。
     输出：对象.for_fit()方法返回一个迭代器。每次会返回一个batch的训练数据。
     """
+    def encode(self, item):
+        return encode_sample(item)
+
     def __iter__(self, random=False):
-        tokenizer,label2id,num_labels = get_value('tokenizer'),get_value('label2id'),get_value('num_labels')
+        num_labels = get_value('num_labels')
         batch_token_ids, batch_segment_ids, batch_labels = [], [], []
         for is_end, item in self.sample(random):    #顺序取每条样本item，is_end为标记表示是否为最后一条记录。
-            token_ids, labels = [tokenizer._token_start_id], [0] #cls的id和0
-            for w, l in item:  #一条样本中的，每个word和label。
-                w_token_ids = tokenizer.encode(w)[0][1:-1]  #对每段单词编码，得到所有字的id。
-                if len(token_ids) + len(w_token_ids) < get_value('maxlen'): #如果已有的字小于最大长度，就加上当前id。
-                    token_ids += w_token_ids
-                    if l == 'O': #如果label为O，labels就直接增加对应长度的0。
-                        labels += [0] * len(w_token_ids)
-                    else:
-                        B = label2id[l] * 2 + 1 #否则就对应到它的开头和中间部分，
-                        I = label2id[l] * 2 + 2
-                        labels += ([B] + [I] * (len(w_token_ids) - 1))
-                else:
-                    break
-                
-            #得到每个样本的字id和label id，长度等于句子长度。token_ids,labels
-            #如果有一个实体正好在最大长度处卡断了，就去除整个实体。
-            token_ids += [tokenizer._token_end_id]
-            labels += [0]                        #输入和输出都加上结束符。label的开始符和结束符都为0。
+            token_ids, labels = self.encode(item)
             segment_ids = [0] * len(token_ids)   #分区id都为0.
             batch_token_ids.append(token_ids)    #将入到batch变量中。token_id，seg_id和label_id都加入batch变量中。
             batch_segment_ids.append(segment_ids)
@@ -98,8 +250,17 @@ class data_generator(DataGenerator):
             if len(batch_token_ids) == self.batch_size or is_end:       #如果是最后一个单词，或者这个batch已经满了。
                 batch_token_ids = sequence_padding(batch_token_ids)
                 batch_segment_ids = sequence_padding(batch_segment_ids)
-                batch_labels = sequence_padding(batch_labels)           #batch中的每个样本都padding到统一长度。
-                batch_labels = to_categorical(batch_labels, num_classes=num_labels)
+                if get_value('sparse_labels'):   #整数标签，padding部分为-1，计算损失和准确率时会被忽略。
+                    batch_labels = sequence_padding(batch_labels, padding=-1, dtype='int32')[:, :, None]
+                else:
+                    batch_labels = sequence_padding(batch_labels)           #batch中的每个样本都padding到统一长度。
+                    batch_labels = to_categorical(batch_labels, num_classes=num_labels)
                 yield [batch_token_ids, batch_segment_ids], batch_labels #返回一个batch的样本。
                 batch_token_ids, batch_segment_ids, batch_labels = [], [], []
-                
+
+
+class encoded_data_generator(data_generator):
+    """数据生成器，data中的样本已经由load_encoded_data编码好，不再重复token化。
+    """
+    def encode(self, item):
+        return item
@@ -33,6 +33,10 @@ def _init():#初始化
          ,'bert_layers':12
          ,'learning_rate':1e-5
          ,'crf_lr_multiplier':1000
+         ,'max_tokens':None   #非None时按token预算动态组batch，batch_size变为每个batch样本数的上限
+         ,'sparse_labels':True   #标签使用整数id(padding为-1)，而不是one hot
+         ,'use_crf':False   #输出层使用CRF（否则为softmax）
+         ,'data_workers':None   #解析数据集的进程数，None为单进程（parallel_apply依赖fork，Windows下保持None）
          }# 必要时扩大CRF层的学习率
     
     #路径配置
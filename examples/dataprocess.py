@@ -28,7 +28,7 @@ from bert4keras.models import build_transformer_model
 from bert4keras.tokenizers import Tokenizer
 from bert4keras.optimizers import Adam
 from bert4keras.snippets import sequence_padding, DataGenerator
-from bert4keras.snippets import ViterbiDecoder, to_array  
+from bert4keras.snippets import ViterbiDecoder, to_array, bio_decode
 from bert4keras.layers import ConditionalRandomField
 from keras.layers import Dense
 from keras.models import Model
@@ -212,21 +212,8 @@ class NamedEntityRecognizer(ViterbiDecoder):
         token_ids, segment_ids = to_array([token_ids], [segment_ids])       
         nodes = model.predict([token_ids, segment_ids])[0]      #预测该样本，得到的是crf的输出
         labels = self.decode(nodes)                             #对输出值进行维特比解码。
-        entities, starting = [], False                      
-        for i, label in enumerate(labels):       #根据预测值，生成样本的实体和对应label的tuple对。
-            if label > 0:
-                if label % 2 == 1:
-                    starting = True
-                    entities.append([[i], id2label[(label - 1) // 2]])
-                elif starting:
-                    entities[-1][0].append(i)
-                else:
-                    starting = False
-            else:
-                starting = False
-
-        return [(text[mapping[w[0]][0]:mapping[w[-1]][-1] + 1], l)
-                for w, l in entities]
+        return [(text[mapping[start][0]:mapping[end][-1] + 1], id2label[t])
+                for start, end, t in bio_decode([labels])[0]]   #根据预测值，生成样本的实体和对应label的tuple对。
 
 
 NER = NamedEntityRecognizer(trans=K.eval(CRF.trans), starts=[0], ends=[0]) 
@@ -28,7 +28,7 @@ from bert4keras.models import build_transformer_model
 from bert4keras.tokenizers import Tokenizer
 from bert4keras.optimizers import Adam
 from bert4keras.snippets import sequence_padding, DataGenerator
-from bert4keras.snippets import ViterbiDecoder, to_array  
+from bert4keras.snippets import ViterbiDecoder, to_array, bio_decode
 from bert4keras.layers import ConditionalRandomField
 from keras.layers import Dense,TimeDistributed,Bidirectional,LSTM,Dropout
 from keras.models import Model
@@ -104,21 +104,8 @@ class NamedEntityRecognizer(object):
         token_ids, segment_ids = to_array([token_ids], [segment_ids])       
         nodes = model.predict([token_ids, segment_ids])[0]      #预测该样本，得到的是crf的输出
         labels = np.argmax(nodes,-1)                           #对输出值进行维特比解码。
-        entities, starting = [], False                      
-        for i, label in enumerate(list(labels)):       #根据预测值，生成样本的实体和对应label的tuple对。
-            if label > 0:
-                if label % 2 == 1:
-                    starting = True
-                    entities.append([[i], id2label[(label - 1) // 2]])
-                elif starting:
-                    entities[-1][0].append(i)
-                else:
-                    starting = False
-            else:
-                starting = False
-
-        return [(text[mapping[w[0]][0]:mapping[w[-1]][-1] + 1], l)
-                for w, l in entities]
+        return [(text[mapping[start][0]:mapping[end][-1] + 1], id2label[t])
+                for start, end, t in bio_decode([labels])[0]]   #根据预测值，生成样本的实体和对应label的tuple对。
     
     def recognize1(self, text):                       #预测text的实体结果，text为一条样本
         tokens = tokenizer.tokenize(text)            # 对其token化,转换成列表，且加入头部和尾部。输出的依然是字。
@@ -130,21 +117,8 @@ class NamedEntityRecognizer(object):
         token_ids, segment_ids = to_array([token_ids], [segment_ids])       
         nodes = model.predict([token_ids, segment_ids])[0]      #预测该样本，得到的是crf的输出
         labels = np.argmax(nodes,-1)                           #对输出值进行维特比解码。
-        entities, starting = [], False                      
-        for i, label in enumerate(list(labels)):       #根据预测值，生成样本的实体和对应label的tuple对。
-            if label > 0:
-                if label % 2 == 1:
-                    starting = True
-                    entities.append([[i], id2label[(label - 1) // 2]])
-                elif starting:
-                    entities[-1][0].append(i)
-                else:
-                    starting = False
-            else:
-                starting = False
-
-        return [(text[mapping[w[0]][0]:mapping[w[-1]][-1] + 1], l,mapping[w[0]][0],mapping[w[-1]][-1] + 1)
-                for w, l in entities]
+        return [(text[mapping[start][0]:mapping[end][-1] + 1], id2label[t],mapping[start][0],mapping[end][-1] + 1)
+                for start, end, t in bio_decode([labels])[0]]   #根据预测值，生成样本的实体和对应label的tuple对。
 
 
 NER = NamedEntityRecognizer() 